@@ -0,0 +1,50 @@
+import hashlib
+import os
+import re
+import subprocess
+
+IMAGE_PREFIX = 'unettest'
+
+
+def digest(directory, exclude=()):
+    """
+    sha256 over every file (path and contents) under `directory`, so two
+    build contexts with the same generated main.py/Dockerfile/requirements
+    hash the same no matter when they were written. Subdirectories named in
+    `exclude` are skipped.
+    """
+    skip = {'__pycache__', *exclude}
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in skip)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, directory).encode())
+            h.update(b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def image_tag(name, directory):
+    """
+    Docker tag for the image built from `directory`, e.g. unettest/bookstore:3f2a...
+    """
+    repo = re.sub(r'[^a-z0-9._-]+', '-', name.lower()).strip('._-') or 'service'
+    return f'{IMAGE_PREFIX}/{repo}:{digest(directory)[:16]}'
+
+
+def built_images():
+    """
+    Set of unettest image tags docker already has. Empty if docker can't be asked.
+    """
+    try:
+        out = subprocess.run(['docker', 'image', 'ls', '--format', '{{.Repository}}:{{.Tag}}', f'{IMAGE_PREFIX}/*'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return set()
+    if out.returncode != 0:
+        return set()
+    return set(out.stdout.split())
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import pickle
+import sys
+
+CACHE_DIR = os.environ.get('UNETTEST_CACHE_DIR', './.unettest_cache')
+
+# bump when what's cached changes shape in a way the source hash won't catch
+CACHE_VERSION = 1
+
+# how many parsed configs to keep around
+KEEP = 20
+
+# the modules whose classes end up pickled
+MODEL_SOURCES = ('config_reader.py', 'service.py', 'test_case.py')
+
+
+def __model_digest():
+    # a pyinstaller build has no sources to hash, its python and
+    # CACHE_VERSION have to do
+    h = hashlib.sha256(f'{CACHE_VERSION} {sys.version}'.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in MODEL_SOURCES:
+        try:
+            with open(os.path.join(here, name), 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+
+def key(raw):
+    """
+    Cache key for the config files' `raw` bytes: their hash, the unettest code
+    that parses them, and the working dir (relative body file paths are resolved
+    against it).
+    """
+    h = hashlib.sha256(raw)
+    h.update(__model_digest().encode())
+    h.update(os.getcwd().encode())
+    return h.hexdigest()
+
+
+def digests(paths):
+    """
+    {path: sha256 of its bytes}, for `still_fresh` to check later.
+    """
+    hashes = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            hashes[path] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def still_fresh(hashes):
+    """
+    Whether every file in `hashes` (from `digests`) is still there, unchanged.
+    """
+    try:
+        return digests(hashes) == hashes
+    except OSError:
+        return False
+
+
+def get(cache_key):
+    """
+    What was `put` under `cache_key`, or None.
+    """
+    path = os.path.join(CACHE_DIR, f'{cache_key}.pickle')
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        # used recently, so not the first to go
+        os.utime(path)
+        return value
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+
+def put(cache_key, value):
+    """
+    Keep `value` under `cache_key`, dropping the oldest entries past KEEP.
+    Concurrent runs (several configs at once) can share CACHE_DIR.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f'{cache_key}.pickle')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+
+    entries = sorted((e for e in os.scandir(CACHE_DIR) if e.name.endswith('.pickle')),
+                     key=lambda e: e.stat().st_mtime, reverse=True)
+    for stale in entries[KEEP:]:
+        try:
+            os.remove(stale.path)
+        except OSError:
+            pass
@@ -1,34 +1,134 @@
+import os
 import yaml
 
+from src import config_cache
 from src.test_case import TestCase
 from src.service import Service
+from src.unettest_exceptions import ParseException
+
+# libyaml's loader is many times faster on big configs, when pyyaml was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load(paths, use_cache=True):
+    """
+    Returns (raw config, tests, services, nginx_spec) for the yaml at `paths`
+    (one path or several, see `read_input_config`).
+
+    What comes out is pickled under a hash of the files' bytes, so running the
+    same config again skips parsing it. It's only reused while every file
+    that went into it, includes too, hashes the same. Editing any of them (or
+    unettest) means parsing again.
+    """
+    roots = [paths] if isinstance(paths, str) else list(paths)
+    raw = b''
+    for path in roots:
+        with open(path, 'rb') as f:
+            raw += os.path.abspath(path).encode() + b'\0' + f.read() + b'\0'
+    cache_key = config_cache.key(raw) if use_cache else None
+    if cache_key:
+        cached = config_cache.get(cache_key)
+        if cached is not None and config_cache.still_fresh(cached[0]):
+            return cached[1]
+
+    config = read_input_config(roots)
+    tests = parse_tests(config['tests'])
+    services = parse_services(config['services'])
+    nginx_spec = parse_nginx(config['nginx']) if 'nginx' in config else {}
+    model = (config, tests, services, nginx_spec)
+    if cache_key:
+        config_cache.put(cache_key, (config_cache.digests(config['files']), model))
+    return model
 
 
 def read_input_config(config):
     """
     Opens and parses well-formatted yaml as defined in the DOCS.
+
+    `config` can be a list of paths too, read as if one file included them
+    all. Files can `include:` others (paths relative to themselves) to share
+    service definitions: everything they define is merged in ahead of the
+    including file's own. A file included twice is read once. `files` lists
+    every file that went in.
+    """
+    merged = {'services': [], 'tests': [], 'files': []}
+    origins = {}
+    for path in [config] if isinstance(config, str) else config:
+        __merge_file(path, merged, origins)
+    return merged
+
+
+def __merge_file(path, merged, origins):
+    path = os.path.abspath(path)
+    if path in merged['files']:
+        return
+    merged['files'].append(path)
+    with open(path, 'rb') as f:
+        y = parse_input_config(f.read())
+    if y is None:
+        raise ParseException(f"Error parsing {path}. Is your yaml well-formed?")
+
+    for include in y.pop('include', None) or []:
+        __merge_file(os.path.join(os.path.dirname(path), os.path.expanduser(include)), merged, origins)
+
+    __merge_named(merged['services'], y.pop('services'), 'service', path, origins)
+    __merge_named(merged['tests'], y.pop('tests'), 'test', path, origins)
+    nginx = y.pop('nginx', None)
+    if nginx is not None:
+        merged_nginx = merged.setdefault('nginx', {})
+        if 'services' in nginx:
+            __merge_named(merged_nginx.setdefault('services', []), nginx.pop('services'), 'nginx service',
+                          path, origins)
+        __merge_settings(merged_nginx, nginx, 'nginx.', path, origins)
+    __merge_settings(merged, y, '', path, origins)
+
+
+def __merge_named(into, named, kind, path, origins):
+    # the same thing defined the same way twice is fine (two test files
+    # including one services file), defined two different ways isn't
+    have = dict(into)
+    for name, conf in named:
+        if name not in have:
+            into.append((name, conf))
+            have[name] = conf
+            origins[(kind, name)] = path
+        elif kind == 'test' or have[name] != conf:
+            raise ParseException(f"{kind} '{name}' is defined in both {origins[(kind, name)]} and {path}")
+
+
+def __merge_settings(into, settings, prefix, path, origins):
+    for key, value in settings.items():
+        if key in into and into[key] != value:
+            raise ParseException(f"{prefix}{key} is set differently in {origins[('setting', prefix + key)]} and {path}")
+        if key not in into:
+            into[key] = value
+            origins[('setting', prefix + key)] = path
+
+
+def parse_input_config(raw):
+    """
+    Parses yaml (bytes or str) the way `read_input_config` does.
     """
-    with open(config) as f:
-        try:
-            y = yaml.safe_load(f)
-
-            # load in my configs as lists of tuples (not supported by yaml afaik)
-            # comes from yaml like {'serv_name': {'route': '/', 'stat...}}
-            # comes from yaml like {'test_name': {'target': '/', 'var...}}
-            # IE {name: content}
-            # I don't want a dict with one key pointing to all the content.
-            # Now it will look like ('serv_name', {'route': '/', 'stat...})
-            # Now it will look like ('test_name', {'target': '/', 'var...})
-            # IE (name, content)
-            # Much better.
-            y['services'] = [(list(c.keys())[0], list(c.values())[0]) for c in y['services']]
-            y['tests'] = [(list(c.keys())[0], list(c.values())[0]) for c in y['tests']]
-            if 'nginx' in y and 'services' in y['nginx']:
-                y['nginx']['services'] = [(list(c.keys())[0], list(c.values())[0]) for c in y['nginx']['services']]
-
-            return y
-        except yaml.YAMLError as e:
-            print(e)
+    try:
+        y = yaml.load(raw, Loader=YamlLoader)
+
+        # load in my configs as lists of tuples (not supported by yaml afaik)
+        # comes from yaml like {'serv_name': {'route': '/', 'stat...}}
+        # comes from yaml like {'test_name': {'target': '/', 'var...}}
+        # IE {name: content}
+        # I don't want a dict with one key pointing to all the content.
+        # Now it will look like ('serv_name', {'route': '/', 'stat...})
+        # Now it will look like ('test_name', {'target': '/', 'var...})
+        # IE (name, content)
+        # Much better.
+        y['services'] = [next(iter(c.items())) for c in y.get('services') or []]
+        y['tests'] = [next(iter(c.items())) for c in y.get('tests') or []]
+        if y.get('nginx') and 'services' in y['nginx']:
+            y['nginx']['services'] = [next(iter(c.items())) for c in y['nginx']['services']]
+
+        return y
+    except yaml.YAMLError as e:
+        print(e)
 
 
 def parse_services(spec):
@@ -0,0 +1,29 @@
+import os
+
+# Added to every port published on the host, so several networks can run
+# side by side. Inside the docker network ports stay as configured, which
+# keeps the nginx confs under test valid.
+PORT_OFFSET = int(os.environ.get('UNETTEST_PORT_OFFSET', 0))
+
+NGINX_PORT = 4999
+LEDGER_PORT = 4888
+
+# Where the runner finds nginx and the ledger. Read these at call time
+# (endpoints.NGINX_URL, not `from ... import`) so configure() takes effect.
+NGINX_URL = f'http://localhost:{NGINX_PORT + PORT_OFFSET}'
+LEDGER_URL = f'http://localhost:{LEDGER_PORT + PORT_OFFSET}'
+
+
+def host_port(port):
+    """
+    The host port a container's `port` is published on.
+    """
+    return port + PORT_OFFSET
+
+
+def configure(nginx_url=None, ledger_url=None):
+    global NGINX_URL, LEDGER_URL
+    if nginx_url:
+        NGINX_URL = nginx_url.rstrip('/')
+    if ledger_url:
+        LEDGER_URL = ledger_url.rstrip('/')
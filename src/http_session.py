@@ -0,0 +1,31 @@
+import requests
+
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+_session = None
+
+
+def configure(pool_size=DEFAULT_POOL_SIZE):
+    """
+    (Re)build the keep-alive session shared by everything unettest sends:
+    test requests to nginx, ledger reads and readiness probes.
+
+    pool_size: connections kept open per host. Give it at least as many as
+               there are tests running at once or they queue for sockets.
+    """
+    global _session
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    # tests must not see each other's cookies just because they share sockets
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    _session = s
+    return s
+
+
+def session():
+    return _session if _session is not None else configure()
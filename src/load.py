@@ -0,0 +1,137 @@
+import itertools
+import math
+import threading
+import time
+import requests
+
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src.service import drain_ledger, reset_ledger
+from src.test import send_to_nginx
+
+Sample = namedtuple('Sample', ['latency', 'status', 'error'])
+
+LEDGER_DRAIN_INTERVAL = 1.0
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _send(test, intended_start):
+    """
+    Fire one test's request, timing it from when it was *meant* to go out so
+    a backed-up client doesn't hide a slow server.
+    """
+    try:
+        resp = send_to_nginx(test.uri, test.req_method, test.request_headers(), test.body, test.body_file)
+        return Sample(time.monotonic() - intended_start, resp.status_code, None)
+    except requests.exceptions.RequestException as e:
+        return Sample(time.monotonic() - intended_start, None, e.__class__.__name__)
+
+
+def _at_rate(tests, rate, duration, workers):
+    samples = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        start = time.monotonic()
+        for i, test in enumerate(itertools.cycle(tests)):
+            due = start + i / rate
+            if due - start >= duration:
+                break
+            pause = due - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            futures.append(pool.submit(_send, test, due))
+        samples = [f.result() for f in futures]
+    return samples
+
+
+def _at_concurrency(tests, concurrency, duration):
+    deadline = time.monotonic() + duration
+    samples = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        mine = []
+        for test in itertools.islice(itertools.cycle(tests), offset, None):
+            if time.monotonic() >= deadline:
+                break
+            mine.append(_send(test, time.monotonic()))
+        with lock:
+            samples.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(i % len(tests),)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def run_load(tests, duration=10.0, rate=None, concurrency=10):
+    """
+    Replay `tests` round-robin against nginx for `duration` seconds, either
+    at a fixed `rate` (requests/second, open loop) or with `concurrency`
+    requests always in flight, then print throughput, latency percentiles,
+    errors and how often each mock route was called.
+
+    Returns the list of Samples.
+    """
+    if not tests:
+        print('LOAD nothing to send, no tests to replay')
+        return []
+    # readiness probes and earlier runs aren't this load's calls
+    reset_ledger()
+    route_calls = Counter()
+    stop = threading.Event()
+
+    def tally_ledger():
+        # keep the ledger small while the load runs
+        while not stop.wait(LEDGER_DRAIN_INTERVAL):
+            route_calls.update(f"{r['service']}.{r['test']}" for r in drain_ledger())
+
+    drainer = threading.Thread(target=tally_ledger)
+    drainer.start()
+    started = time.monotonic()
+    try:
+        if rate:
+            samples = _at_rate(tests, rate, duration, workers=concurrency)
+        else:
+            samples = _at_concurrency(tests, concurrency, duration)
+    finally:
+        elapsed = time.monotonic() - started
+        stop.set()
+        drainer.join()
+    route_calls.update(f"{r['service']}.{r['test']}" for r in drain_ledger())
+
+    report_load(samples, elapsed, route_calls, rate, concurrency)
+    return samples
+
+
+def report_load(samples, elapsed, route_calls, rate, concurrency):
+    latencies = sorted(s.latency * 1000 for s in samples)
+    statuses = Counter(s.status for s in samples if s.status is not None)
+    failures = Counter(s.error or s.status for s in samples if s.error or s.status >= 500)
+    n = len(samples) or 1
+
+    mode = f'rate {rate}/s' if rate else f'concurrency {concurrency}'
+    print()
+    print(f'LOAD RESULTS ({elapsed:.1f}s, {mode})')
+    print(f'  requests      {len(samples)} ({len(samples) / elapsed:.1f}/s)')
+    print(f'  latency ms    p50 {percentile(latencies, 50):.1f}   p95 {percentile(latencies, 95):.1f}'
+          f'   p99 {percentile(latencies, 99):.1f}   max {(latencies or [0])[-1]:.1f}')
+    print(f'  errors        {sum(failures.values())} ({100 * sum(failures.values()) / n:.1f}%)'
+          + ''.join(f'   {kind} x{count}' for kind, count in failures.most_common()))
+    print('  statuses     ' + ''.join(f' {status} x{count}' for status, count in sorted(statuses.items())))
+    print(f'  upstream calls per request  {sum(route_calls.values()) / n:.2f}')
+    for route, count in route_calls.most_common():
+        print(f'    {route}  {count}')
+    print()
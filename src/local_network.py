@@ -3,15 +3,18 @@ import requests
 import subprocess
 import time
 
-from src.ondisk_config import WORK_DIR
+from src.ondisk_config import COMPOSE_FILE, DOCKER_COMPOSE, WORK_DIR
 from src.ondisk_config import reload_nginx_config
+from src.timings import phase
 
+@phase('tear_down')
 def tear_down():
-    os.system('docker-compose down')
+    os.system(f'{DOCKER_COMPOSE} down')
     os.system(f'rm -rf {WORK_DIR}')
     os.system(f'echo "unettest has finished its business"')
 
 
+@phase('spin_up')
 def spin_up(detach=True, build=True, reboot_openresty=False):
     """
     reboot_openresty: when openresty is running side by side with a uwsgi
@@ -22,15 +25,25 @@ def spin_up(detach=True, build=True, reboot_openresty=False):
     build_arg = " --build " if build else ""
     detach_arg = " --detach " if detach else ""
     if not detach:
-        p = subprocess.Popen(['/usr/local/bin/docker-compose', 'up', '--build'])
+        p = subprocess.Popen(['/usr/local/bin/docker-compose', '-f', COMPOSE_FILE, 'up', '--build'])
         if reboot_openresty:
             print('nginx reloading!!!!')
             reload_nginx_config()
             print('nginx reloaded!!!!')
         p.wait()
     else:
-        os.system(f'docker-compose up {build_arg} {detach_arg}')
+        with phase('docker-compose up'):
+            os.system(f'{DOCKER_COMPOSE} up {build_arg} {detach_arg}')
         if reboot_openresty:
             print('nginx reloading!!!!')
             reload_nginx_config()
             print('nginx reloading!!!!')
+
+
+@phase('rebuild_services')
+def rebuild_services(names):
+    """
+    Rebuild and restart just the named compose services, leaving the rest of
+    the network running.
+    """
+    os.system(f'{DOCKER_COMPOSE} up --detach --build --remove-orphans {" ".join(names)}')
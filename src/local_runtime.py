@@ -0,0 +1,79 @@
+import os
+import socket
+import subprocess
+import sys
+
+from src import endpoints
+from src.ondisk_config import WORK_DIR, mk_local_mocks
+from src.timings import phase
+from src.unettest_exceptions import ServicesNotReadyException
+
+__mocks = None
+
+
+@phase('spin_up')
+def spin_up(services, detach=True):
+    """
+    Run every mock service and the ledger in one python process on this
+    machine, no docker involved. Each mock listens on its exposed_port and
+    the ledger on 4888, same as under docker-compose, plus
+    UNETTEST_PORT_OFFSET.
+
+    The requests have to come from an nginx you run yourself (see
+    endpoints.NGINX_URL), with upstreams pointing at localhost.
+
+    Raises ServicesNotReadyException if any of those ports is taken, since
+    whatever holds it would answer in our place.
+    """
+    global __mocks
+    ports = [endpoints.host_port(s.exposed_port) for s in services.values()]
+    busy = __taken([*ports, endpoints.host_port(endpoints.LEDGER_PORT)])
+    if busy:
+        raise ServicesNotReadyException(f"port {', '.join(map(str, busy))} already in use, "
+                                        'is another unettest (or anything else) running?')
+    mocks_dir = mk_local_mocks(services)
+    env = {**os.environ, 'LEDGER_URL': f'{endpoints.LEDGER_URL}/log',
+           'UNETTEST_PORT_OFFSET': str(endpoints.PORT_OFFSET)}
+    log = None if not detach else open(f'{mocks_dir}/mocks.log', 'w')
+    __mocks = subprocess.Popen([sys.executable, 'main.py'], cwd=mocks_dir, env=env,
+                               stdout=log, stderr=subprocess.STDOUT if log else None)
+    if not detach:
+        __mocks.wait()
+
+
+def __taken(ports):
+    busy = []
+    for port in ports:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            # same as the mocks will, so a socket in TIME_WAIT doesn't count
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind(('0.0.0.0', port))
+            except OSError:
+                busy.append(port)
+    return busy
+
+
+def exited():
+    """
+    Why the mocks process isn't running any more, or None while it is.
+    """
+    if __mocks is None or __mocks.poll() is None:
+        return None
+    return f'mocks exited with {__mocks.returncode}, see {WORK_DIR}/mocks/mocks.log'
+
+
+@phase('tear_down')
+def tear_down():
+    if __mocks is None:
+        # never started, maybe because its ports were taken. the work dir
+        # could be another run's
+        return
+    if __mocks.poll() is None:
+        __mocks.terminate()
+        try:
+            __mocks.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            __mocks.kill()
+    os.system(f'rm -rf {WORK_DIR}')
+    print("unettest has finished its business")
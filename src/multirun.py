@@ -0,0 +1,137 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src import reporting
+
+RUNS_DIR = './.unettest_runs'
+
+# each run's published ports are shifted this much further than the last's
+PORT_STEP = 1000
+
+Run = namedtuple('Run', ['config', 'name', 'returncode', 'output', 'reports'])
+
+
+def run_names(configs):
+    """
+    A short, unique, compose-safe name per config file.
+    """
+    names = []
+    for config in configs:
+        base = re.sub(r'[^a-z0-9_]+', '_', os.path.splitext(os.path.basename(config))[0].lower()).strip('_')
+        name, n = base or 'config', 1
+        while name in names:
+            n += 1
+            name = f'{base}_{n}'
+        names.append(name)
+    return names
+
+
+def passthrough_args(argv, configs, drop):
+    """
+    `argv` without the config files and without the options in `drop`
+    (and their values), for handing on to each run.
+    """
+    args, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in configs:
+            continue
+        elif arg in drop:
+            skip = True
+        elif arg.split('=')[0] in drop:
+            continue
+        else:
+            args.append(arg)
+    return args
+
+
+def __self_command():
+    # a pyinstaller build is its own interpreter
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, os.path.abspath(sys.argv[0])]
+
+
+def __own_file(path, name):
+    # history.json -> history.<name>.json
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{name}{ext}'
+
+
+def __run(config, name, index, args, own_files):
+    run_dir = f'{RUNS_DIR}/{name}'
+    os.makedirs(run_dir, exist_ok=True)
+    results = f'{run_dir}/results.json'
+    for option, path in own_files.items():
+        if path:
+            args = [*args, option, __own_file(path, name)]
+    env = {**os.environ,
+           'COMPOSE_PROJECT_NAME': f'unettest_{name}',
+           'UNETTEST_COMPOSE_FILE': f'{run_dir}/docker-compose.yml',
+           'COMPOSE_FILE': f'{run_dir}/docker-compose.yml',
+           'UNETTEST_WORK_DIR': f'{run_dir}/apps',
+           'UNETTEST_PORT_OFFSET': str(index * PORT_STEP)}
+    proc = subprocess.run([*__self_command(), config, *args, '--report-json', results],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        with open(results) as f:
+            reports = reporting.from_json(json.load(f))
+    except (OSError, ValueError):
+        reports = None
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return Run(config, name, proc.returncode, proc.stdout, reports)
+
+
+def run_configs(configs, args, parallel=None, history=None, trace=None):
+    """
+    Run unettest once per config file with the same `args`, `parallel` at a
+    time (default: all at once). Every run gets its own compose project, work
+    dir and published ports, so their networks never meet, and its own
+    --changed-only record next to `history` and --trace next to `trace`.
+
+    Prints each run's output once it's done, then a summary. Returns the
+    Runs in the order of `configs`.
+    """
+    names = run_names(configs)
+    own_files = {'--history': history, '--trace': trace}
+    runs = {}
+    with ThreadPoolExecutor(max_workers=parallel or len(configs)) as pool:
+        futures = {pool.submit(__run, config, name, i, args, own_files): config
+                   for i, (config, name) in enumerate(zip(configs, names))}
+        for future in as_completed(futures):
+            run = future.result()
+            runs[run.config] = run
+            print(f'\n==== {run.config} ====')
+            print(run.output, end='')
+
+    runs = [runs[config] for config in configs]
+    print('\nCONFIGS')
+    for run in runs:
+        if run.reports is None:
+            print(f'  ERROR {run.config}  (exited {run.returncode} without results)')
+            continue
+        failures = sum(1 for r in run.reports if not r.success)
+        verdict = 'ok   ' if run.returncode == 0 else 'FAIL '
+        print(f'  {verdict} {run.config}  {len(run.reports)} tests, {failures} failures')
+    return runs
+
+
+def write_reports(runs, json_path=None, junit_path=None):
+    """
+    Write the results of every run to one JSON and/or one JUnit file, a
+    section (testsuite) per config.
+    """
+    finished = [run for run in runs if run.reports is not None]
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'configs': {run.config: reporting.to_json(run.reports) for run in finished}}, f, indent=2)
+    if junit_path:
+        reporting.write_junit(junit_path, [(run.name, run.reports) for run in finished])
@@ -1,42 +1,115 @@
 import yaml
 import os
+import shlex
+import shutil
 import subprocess
 
-from src.service import Service
+from src.service import Service, ASYNC_REQUIREMENTS
+from src import build_cache
+from src.endpoints import host_port, LEDGER_PORT, NGINX_PORT
+from src.timings import phase
 
 from src.unettest_exceptions import ParseException
 
-WORK_DIR = './.unettest_apps'
+# both can be moved (by env var) so several runs can share a directory.
+# not $COMPOSE_FILE, that's likely pointing at the user's own project
+WORK_DIR = os.environ.get('UNETTEST_WORK_DIR', './.unettest_apps')
+COMPOSE_FILE = os.environ.get('UNETTEST_COMPOSE_FILE', 'docker-compose.yml')
+# always name the file, so an exported $COMPOSE_FILE can't redirect compose
+DOCKER_COMPOSE = f'docker-compose -f {shlex.quote(COMPOSE_FILE)}'
 NGINX_DEFAULT_DIR = './nginx/'
+MULTIPLEXER_NAME = 'mocks'
 
 
-def mk_architecture(services, nginx_spec, nginx_conf_dir):
+@phase('mk_architecture')
+def mk_architecture(services, nginx_spec, nginx_conf_dir, single_container=False, use_build_cache=True):
     """
     Catch-all env-creator. Run this to set up everything.
-    """
-    if not nginx_conf_dir:
-        nginx_conf_dir = NGINX_DEFAULT_DIR
 
+    single_container: serve every mock service and the ledger from one
+                      process in one image instead of an image apiece.
+    use_build_cache: tag mock images by a hash of what goes into them and
+                     skip building the ones docker already has.
+    """
     __mk_workspace()
 
-    if 'NGINX_CONFIG' in os.environ:
-        print('USING NGINX CONFS set by env var NGINX_CONFIG')
-        nginx_conf_dir = os.environ['NGINX_CONFIG']
-
+    nginx_conf_dir = resolve_nginx_conf_dir(nginx_conf_dir)
     print(f'LOADING NGINX CONFS located at {nginx_conf_dir}')
 
-    for service_name, service in services.items():
-        __add_service(service_name, service.routes, service.exposed_port, Service.generate_service)
+    if single_container:
+        __add_multiplexer(services)
+    else:
+        for service_name, service in services.items():
+            __add_service(service_name, service.routes, service.exposed_port, Service.generate_async_service)
 
-    __add_service('ledger', [], 4888, Service.generate_ledger)
+        __add_service('ledger', [], LEDGER_PORT, Service.generate_ledger)
 
     __configure_nginx(nginx_spec, nginx_conf_dir)
 
     custom_mounts = nginx_spec.get('custom_mount', [])
     use_default = nginx_spec.get('use_default', False)
-    __add_dockercompose(services, custom_mounts, use_default)
+    __add_dockercompose(services, custom_mounts, use_default, single_container, use_build_cache)
 
 
+@phase('mk_local_mocks')
+def mk_local_mocks(services):
+    """
+    Generate just the mock services and the ledger, as one app to run on
+    this machine without docker. Returns the directory holding its main.py.
+    """
+    __mk_workspace()
+    __add_multiplexer(services)
+    return f'{WORK_DIR}/{MULTIPLEXER_NAME}'
+
+
+def resolve_nginx_conf_dir(nginx_conf_dir):
+    """
+    The nginx conf dir that will be used: $NGINX_CONFIG beats --nginx-conf
+    beats the default ./nginx/.
+    """
+    if 'NGINX_CONFIG' in os.environ:
+        print('USING NGINX CONFS set by env var NGINX_CONFIG')
+        return os.environ['NGINX_CONFIG']
+    return nginx_conf_dir or NGINX_DEFAULT_DIR
+
+
+def refresh_nginx_conf(input_nginxconf):
+    """
+    Copy the nginx confs into WORK_DIR again. The running nginx container
+    mounts that dir, so a reload is all it takes to pick them up.
+    """
+    conf_dir = f'{WORK_DIR}/nginx_server/conf'
+    if not os.path.exists(conf_dir):
+        os.mkdir(conf_dir)
+    os.system(f'rm -rf {conf_dir}/*')
+    input_nginxconf = input_nginxconf.rstrip('/')
+    os.system(f'cp -r {input_nginxconf}/* {conf_dir}')
+    os.system(f"LC_ALL=C find {conf_dir} -type f -exec sed -i.bak -e 's:resolver [0-9]*\\.[0-9]*\\.[0-9]*\\.[0-9]*:resolver 127.0.0.11:' {{}} \\;")
+
+
+@phase('reload_nginx')
+def reload_nginx():
+    """
+    Ask the running nginx to re-read its confs without restarting the container.
+    """
+    nid = __get_nginx_dockerid()
+    os.system(f'docker exec {nid} openresty -s reload')
+
+
+def build_digests():
+    """
+    {image dir name: content hash} for everything in WORK_DIR that gets built
+    into an image. nginx confs are mounted, not built, so they don't count.
+    """
+    digests = {}
+    for name in sorted(os.listdir(WORK_DIR)):
+        path = f'{WORK_DIR}/{name}'
+        if os.path.isdir(path):
+            digests[name] = build_cache.digest(path, exclude=['conf'] if name == 'nginx_server' else [])
+    return digests
+
+
+@phase('reload_nginx_config')
 def reload_nginx_config():
     """ HACK ALERT!!!
     
@@ -58,12 +131,12 @@ def reload_nginx_config():
 
 
 def __get_nginx_dockerid():
-    return subprocess.getoutput("docker ps --filter name='nginx' -q")
+    # ask compose, not docker, so another run's nginx is never picked
+    return subprocess.getoutput(f'{DOCKER_COMPOSE} ps -q nginx_server')
 
 
 def __mk_workspace():
-    if not os.path.exists(WORK_DIR):
-        os.mkdir(WORK_DIR)
+    os.makedirs(WORK_DIR, exist_ok=True)
 
 
 def __add_service(name, routes, exposed_port, constructor):
@@ -75,31 +148,104 @@ def __add_service(name, routes, exposed_port, constructor):
     if not os.path.exists(f'{WORK_DIR}/{name}'):
         os.mkdir(f'{WORK_DIR}/{name}')
     constructor(name, f'{WORK_DIR}/{name}/main.py', routes)
+    __copy_body_files(f'{WORK_DIR}/{name}', routes)
     Service.insert_dockerfile(f'{WORK_DIR}/{name}/Dockerfile', exposed_port)
-    Service.insert_requirements(f'{WORK_DIR}/{name}/requirements.txt')
+    Service.insert_requirements(f'{WORK_DIR}/{name}/requirements.txt', ASYNC_REQUIREMENTS)
+
+def __add_multiplexer(services):
+    """
+    Configure local directory to later build into the one docker image that
+    hosts every SERVICE and the ledger.
+
+    MAKES DIR mocks
+    """
+    mux_dir = f'{WORK_DIR}/{MULTIPLEXER_NAME}'
+    if not os.path.exists(mux_dir):
+        os.mkdir(mux_dir)
+    apps = []
+    for service_name, service in services.items():
+        Service.generate_async_service(service_name, f'{mux_dir}/svc_{service_name}.py', service.routes)
+        __copy_body_files(mux_dir, service.routes)
+        apps.append((f'svc_{service_name}', service.exposed_port))
+    Service.generate_ledger('ledger', f'{mux_dir}/svc_ledger.py', [])
+    apps.append(('svc_ledger', LEDGER_PORT))
+
+    Service.generate_multiplexer(f'{mux_dir}/main.py', apps)
+    Service.insert_multiplexer_dockerfile(f'{mux_dir}/Dockerfile', [port for _, port in apps])
+    Service.insert_requirements(f'{mux_dir}/requirements.txt', ASYNC_REQUIREMENTS)
 
-def __add_dockercompose(services, custom_mounts, use_default):
+def __copy_body_files(app_dir, routes):
+    """
+    Copy the files routes answer with into the app's build context, where
+    the generated code expects them.
+    """
+    for route in routes:
+        if route.body_file:
+            os.makedirs(os.path.dirname(f'{app_dir}/{route.body["file"]}'), exist_ok=True)
+            shutil.copyfile(route.body_file, f'{app_dir}/{route.body["file"]}')
+
+def __add_build(f, name, cached_images):
+    """
+    Write the compose `build` for the image in WORK_DIR/name. With the build
+    cache on (`cached_images` not None) the image is tagged by content hash
+    and the `build` is left out when docker already has that tag.
+    """
+    build_dir = f'{WORK_DIR}/{name}'
+    if cached_images is not None:
+        tag = build_cache.image_tag(name, build_dir)
+        f.write(f'    image: {tag}\n')
+        if tag in cached_images:
+            print(f'REUSING IMAGE {tag}')
+            return
+    f.write(f'    build: {os.path.abspath(build_dir)}\n')
+
+def __add_dockercompose(services, custom_mounts, use_default, single_container=False, use_build_cache=False):
     """
     Accept list of Services and write to disk a docker-compose file.
+
+    Container ports are as configured. Host ports are shifted by
+    UNETTEST_PORT_OFFSET and paths are absolute, so the file works from
+    wherever UNETTEST_COMPOSE_FILE puts it.
     """
-    with open(f'docker-compose.yml', 'w') as f:
+    cached_images = build_cache.built_images() if use_build_cache else None
+    work_dir = os.path.abspath(WORK_DIR)
+    with open(COMPOSE_FILE, 'w') as f:
         f.write("version: '3'\n")
         f.write("services:\n")
-        for name, service in services.items():
-            f.write(f'  {name}:\n')
-            f.write(f'    build: {WORK_DIR}/{name}\n')
+        if single_container:
+            # one container answering to every service's hostname
+            f.write(f'  {MULTIPLEXER_NAME}:\n')
+            __add_build(f, MULTIPLEXER_NAME, cached_images)
             f.write(f'    ports:\n')
-            f.write(f'      - "{service.exposed_port}:{service.exposed_port}"\n')
-            f.write(f'    expose:\n')
-            f.write(f'      - {service.exposed_port}\n')
-        f.write(f'  ledger:\n')
-        f.write(f'    build: {WORK_DIR}/ledger\n')
-        f.write(f'    ports:\n')
-        f.write(f'      - "4888:4888"\n')
+            for service in services.values():
+                f.write(f'      - "{host_port(service.exposed_port)}:{service.exposed_port}"\n')
+            f.write(f'      - "{host_port(LEDGER_PORT)}:{LEDGER_PORT}"\n')
+            f.write(f'    environment:\n')
+            f.write(f'      - LEDGER_SIZE\n')
+            f.write(f'    networks:\n')
+            f.write(f'      default:\n')
+            f.write(f'        aliases:\n')
+            for name in services:
+                f.write(f'          - {name}\n')
+            f.write(f'          - ledger\n')
+        else:
+            for name, service in services.items():
+                f.write(f'  {name}:\n')
+                __add_build(f, name, cached_images)
+                f.write(f'    ports:\n')
+                f.write(f'      - "{host_port(service.exposed_port)}:{service.exposed_port}"\n')
+                f.write(f'    expose:\n')
+                f.write(f'      - {service.exposed_port}\n')
+            f.write(f'  ledger:\n')
+            __add_build(f, 'ledger', cached_images)
+            f.write(f'    ports:\n')
+            f.write(f'      - "{host_port(LEDGER_PORT)}:{LEDGER_PORT}"\n')
+            f.write(f'    environment:\n')
+            f.write(f'      - LEDGER_SIZE\n')
         f.write(f'  nginx_server:\n')
-        f.write(f'    build: {WORK_DIR}/nginx_server\n')
+        f.write(f'    build: {work_dir}/nginx_server\n')
         f.write(f'    ports:\n')
-        f.write(f'      - "4999:80"\n')
+        f.write(f'      - "{host_port(NGINX_PORT)}:80"\n')
         f.write(f'    environment:\n')
         f.write(f'      - env=dev\n')
         f.write(f'    expose:\n')
@@ -108,12 +254,12 @@ def __add_dockercompose(services, custom_mounts, use_default):
         # f.write(f'      - {WORK_DIR}/nginx_server/conf:/etc/nginx/conf.d\n')
         # f.write(f'      - ./scripts:/usr/local/openresty/scripts\n')
         if use_default:
-            f.write(f'      - {WORK_DIR}/nginx_server/conf:/etc/nginx/conf.d\n')
+            f.write(f'      - {work_dir}/nginx_server/conf:/etc/nginx/conf.d\n')
         else:
-            f.write(f'      - {WORK_DIR}/nginx_server/conf:/usr/local/openresty/nginx/conf\n')
+            f.write(f'      - {work_dir}/nginx_server/conf:/usr/local/openresty/nginx/conf\n')
 
         for mount in custom_mounts:
-            f.write(f'      - {WORK_DIR}/nginx_server/conf:{mount}\n')
+            f.write(f'      - {work_dir}/nginx_server/conf:{mount}\n')
 
 
 def __configure_nginx(nginx_spec, input_nginxconf=''):
@@ -124,13 +270,7 @@ def __configure_nginx(nginx_spec, input_nginxconf=''):
     """
     if not os.path.exists(f'{WORK_DIR}/nginx_server'):
         os.mkdir(f'{WORK_DIR}/nginx_server')
-    if not os.path.exists(f'{WORK_DIR}/nginx_server/conf'):
-        os.mkdir(f'{WORK_DIR}/nginx_server/conf')
-    os.system(f'rm -rf {WORK_DIR}/nginx_server/conf/*')
-    input_nginxconf = input_nginxconf.rstrip('/')
-    os.system(f'cp -r {input_nginxconf}/* {WORK_DIR}/nginx_server/conf')
-    os.system(f"LC_ALL=C find {WORK_DIR}/nginx_server/conf -type f -exec sed -i.bak -e 's:resolver [0-9]*\.[0-9]*\.[0-9]*\.[0-9]*:resolver 127.0.0.11:' {{}} \;")
-    
+    refresh_nginx_conf(input_nginxconf)
 
     with open(f'{WORK_DIR}/nginx_server/Dockerfile', 'w') as f:
         f.write("""from openresty/openresty:buster-fat\n""")
@@ -138,6 +278,7 @@ def __configure_nginx(nginx_spec, input_nginxconf=''):
     if nginx_spec and 'services' in nginx_spec:
         for service_name, service in nginx_spec['services'].items():
             Service.generate_service(service_name, f'{WORK_DIR}/nginx_server/main.py', service.routes)
+            __copy_body_files(f'{WORK_DIR}/nginx_server', service.routes)
             Service.insert_requirements(f'{WORK_DIR}/nginx_server/requirements.txt')
             service.insert_uwsgi(f'{WORK_DIR}/nginx_server/')
 
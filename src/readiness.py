@@ -0,0 +1,92 @@
+import time
+import requests
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src import endpoints
+from src.http_session import session
+from src.timings import phase
+from src.unettest_exceptions import ServicesNotReadyException
+
+Probe = namedtuple('Probe', ['name', 'url', 'is_ready'])
+Readiness = namedtuple('Readiness', ['name', 'ready', 'seconds', 'last_error'])
+
+
+def _answers_ok(resp):
+    return resp.status_code == 200
+
+
+def _answers_at_all(resp):
+    # nginx is up as soon as it speaks http; whatever it says about `/` is
+    # down to the config under test.
+    return True
+
+
+def probes_for(services):
+    """
+    One Probe per mock service, plus the ledger and nginx.
+    """
+    probes = [Probe(name, f'http://localhost:{endpoints.host_port(s.exposed_port)}/', _answers_ok)
+              for name, s in services.items()]
+    probes.append(Probe('ledger', f'{endpoints.LEDGER_URL}/', _answers_ok))
+    probes.append(Probe('nginx', f'{endpoints.NGINX_URL}/', _answers_at_all))
+    return probes
+
+
+def poll(probe, deadline, first_delay=0.05, max_delay=2.0, exited=None):
+    """
+    Hit `probe` until it is ready or `deadline` (a time.monotonic() value)
+    passes, doubling the pause between attempts up to `max_delay`.
+
+    exited: called between attempts, gives up early if it returns a reason
+            (the process that should be answering has died).
+    """
+    start = time.monotonic()
+    delay = first_delay
+    last_error = None
+    while True:
+        remaining = deadline - time.monotonic()
+        gone = exited() if exited else None
+        if gone:
+            return Readiness(probe.name, False, time.monotonic() - start, gone)
+        if remaining <= 0:
+            return Readiness(probe.name, False, time.monotonic() - start, last_error)
+        try:
+            resp = session().get(probe.url, timeout=min(remaining, max_delay))
+            if probe.is_ready(resp):
+                return Readiness(probe.name, True, time.monotonic() - start, None)
+            last_error = f'answered {resp.status_code}'
+        except requests.exceptions.RequestException as e:
+            last_error = e.__class__.__name__
+        time.sleep(max(0, min(delay, deadline - time.monotonic())))
+        delay = min(delay * 2, max_delay)
+
+
+@phase('wait_until_up')
+def wait_until_up(services, timeout=60, exited=None):
+    """
+    Probe every mock service, the ledger and nginx side by side and return
+    once they all answer, printing how long each one took.
+
+    Raises ServicesNotReadyException naming the stragglers if they are not
+    all up within `timeout` seconds, or as soon as `exited` (see `poll`)
+    gives a reason.
+    """
+    probes = probes_for(services)
+    deadline = time.monotonic() + timeout
+    with ThreadPoolExecutor(max_workers=len(probes)) as pool:
+        results = list(pool.map(lambda p: poll(p, deadline, exited=exited), probes))
+    gone = exited() if exited else None
+    if gone:
+        raise ServicesNotReadyException(gone)
+
+    for r in results:
+        if r.ready:
+            print(f'  {r.name} up after {r.seconds:.2f}s')
+
+    not_ready = [r for r in results if not r.ready]
+    if not_ready:
+        details = ', '.join(f'{r.name} ({r.last_error})' for r in not_ready)
+        raise ServicesNotReadyException(f'not up after {timeout}s: {details}')
+    return results
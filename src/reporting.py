@@ -0,0 +1,185 @@
+import io
+import json
+import sys
+import xml.etree.ElementTree as ET
+
+from collections import namedtuple
+
+# one line of a test's report. kind is 'route' (the route isn't defined on the
+# mock), 'called' (expected is the route's path), 'not_called' (for
+# called_times: 0, actual is how many times it was), 'called_times', 'status',
+# 'method', 'body_size', 'body_sha256' or 'until_called' for an expect, or 'response_ms' or
+# 'upstream_hops' for the test as a whole (service and route are None)
+Assertion = namedtuple('Assertion', ['service', 'route', 'kind', 'expected', 'actual', 'success'])
+
+# kinds that compare against a budget and show what they got
+BUDGETS = {'until_called', 'response_ms', 'upstream_hops', 'called_times', 'not_called', 'body_size'}
+
+# a call a mock answered on the test's behalf. arrived and answered are in
+# milliseconds after the test's request went out
+Hop = namedtuple('Hop', ['route', 'arrived', 'answered', 'forwarded'])
+
+# timings are in milliseconds: request (the request through nginx), drain
+# (getting the records back from the ledger), assert (checking them), total.
+# when a mock was reached, also first_upstream (until the first mock got the
+# call), upstream (time some mock was busy answering) and nginx (the rest of
+# the request). hops are in the order the mocks got them.
+Report = namedtuple('Report', ['test_name', 'success', 'hits', 'assertions', 'timings', 'hops'],
+                    defaults=((), {}, ()))
+
+
+def describe(assertion):
+    if assertion.kind == 'route':
+        return f"no route found '{assertion.route}' in {assertion.service}"
+    if assertion.kind == 'called':
+        return f'asserting target route {assertion.route} {assertion.expected} was called'
+    if assertion.kind == 'not_called':
+        return f'asserting target route {assertion.route} {assertion.expected} was not called'
+    if assertion.kind == 'called_times':
+        return f'it was called {assertion.expected} times'
+    if assertion.kind == 'status':
+        return f'that endpoint returned {assertion.expected}'
+    if assertion.kind == 'body_size':
+        return f'it got a {assertion.expected} byte body'
+    if assertion.kind == 'body_sha256':
+        return f'it got a body with sha256 {assertion.expected[:12]}...'
+    if assertion.kind == 'until_called':
+        return f'it was called within {assertion.expected}ms'
+    if assertion.kind == 'response_ms':
+        return f'asserting the response came back within {assertion.expected}ms'
+    if assertion.kind == 'upstream_hops':
+        return f'asserting at most {assertion.expected} upstream calls'
+    return f'it was invoked with {assertion.expected}'
+
+
+def verdict(assertion):
+    answer = 'Yes' if assertion.success else 'No'
+    if assertion.kind not in BUDGETS:
+        return answer
+    if assertion.kind in ('upstream_hops', 'called_times', 'body_size'):
+        return f'{answer} ({assertion.actual})'
+    if assertion.kind == 'not_called':
+        return answer if assertion.success else f'{answer} (called {assertion.actual} times)'
+    return f'{answer} ({assertion.actual:.1f}ms)' if assertion.actual is not None else f'{answer} (never)'
+
+
+class ConsoleReporter:
+    """
+    Prints each test's report the way unettest always has, but a whole test
+    at a time instead of a line at a time.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def test_done(self, test, report):
+        out = io.StringIO()
+        print(file=out)
+        print("Testing", report.test_name, file=out)
+        in_expect = False
+        for a in report.assertions:
+            if in_expect and a.kind in ('called', 'not_called', 'route', 'response_ms', 'upstream_hops'):
+                print(file=out)
+                in_expect = False
+            if a.kind == 'route':
+                print(f'  {describe(a)}', file=out)
+            elif a.kind in ('called', 'not_called'):
+                print(f'  {describe(a)} . . . ', end='', file=out)
+                print(verdict(a) if a.success else f'\t{verdict(a)}', file=out)
+                in_expect = True
+            elif a.service is None:
+                print(f'  {describe(a)} . . . \t{verdict(a)}', file=out)
+            else:
+                print(f'            {describe(a)} . . . \t{verdict(a)}', file=out)
+        if in_expect:
+            print(file=out)
+        if report.hops:
+            print('  upstream ' + ' -> '.join(f'{h.route} (+{h.arrived:.1f}ms)' for h in report.hops), file=out)
+            print(f"  nginx added {report.timings['nginx']:.1f}ms of {report.timings['request']:.1f}ms", file=out)
+        self.stream.write(out.getvalue())
+
+    def finish(self, reports):
+        print(file=self.stream)
+        self.stream.flush()
+
+
+def to_json(reports):
+    return {
+        'tests': len(reports),
+        'failures': sum(1 for r in reports if not r.success),
+        'results': [{
+            'name': r.test_name,
+            'success': r.success,
+            'timings': r.timings,
+            'hits': list(r.hits),
+            'assertions': [a._asdict() for a in r.assertions],
+            'hops': [h._asdict() for h in r.hops],
+        } for r in reports],
+    }
+
+
+def from_json(data):
+    """
+    Reports back from what `to_json` made.
+    """
+    return [Report(r['name'], r['success'], r['hits'],
+                   [Assertion(**a) for a in r['assertions']], r['timings'],
+                   [Hop(**h) for h in r['hops']])
+            for r in data['results']]
+
+
+def write_junit(path, suites):
+    """
+    Write JUnit XML to `path` with a testsuite per (name, reports) in `suites`.
+    """
+    root = ET.Element('testsuites')
+    for suite_name, reports in suites:
+        failures = [r for r in reports if not r.success]
+        total_ms = sum(r.timings.get('total', 0) for r in reports)
+        suite = ET.SubElement(root, 'testsuite', name=suite_name, tests=str(len(reports)),
+                              failures=str(len(failures)), errors='0', time=f'{total_ms / 1000:.3f}')
+        for r in reports:
+            case = ET.SubElement(suite, 'testcase', name=r.test_name, classname=suite_name,
+                                 time=f"{r.timings.get('total', 0) / 1000:.3f}")
+            props = ET.SubElement(case, 'properties')
+            for name, ms in r.timings.items():
+                ET.SubElement(props, 'property', name=f'{name}_ms', value=f'{ms:.1f}')
+            failed = [a for a in r.assertions if not a.success]
+            if failed:
+                failure = ET.SubElement(case, 'failure', message=describe(failed[0]))
+                failure.text = '\n'.join(
+                    f"{f'{a.service}.{a.route}: ' if a.service else ''}{describe(a)} (got {a.actual})" for a in failed)
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+
+
+class JsonReporter:
+    """
+    Writes every test's assertions and timings to `path` once the run is over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def test_done(self, test, report):
+        pass
+
+    def finish(self, reports):
+        with open(self.path, 'w') as f:
+            json.dump(to_json(reports), f, indent=2)
+
+
+class JUnitReporter:
+    """
+    Writes a JUnit XML file to `path` once the run is over, one testcase per
+    test, for CI servers to chart.
+    """
+
+    def __init__(self, path, suite='unettest'):
+        self.path = path
+        self.suite = suite
+
+    def test_done(self, test, report):
+        pass
+
+    def finish(self, reports):
+        write_junit(self.path, [(self.suite, reports)])
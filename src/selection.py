@@ -0,0 +1,302 @@
+import hashlib
+import json
+import os
+import re
+
+HISTORY_FILE = './.unettest_history.json'
+
+LOCATION = re.compile(r'(?:^|(?<=[\s;{}]))location\s+([^{;]*?)\s*\{')
+COMMENT = re.compile(r'(?:^|(?<=\s))#[^\n]*')
+LOCATION_MODIFIER = re.compile(r'^(=|\^~|~\*|~)?\s*(.*)$')
+UPSTREAM = re.compile(r'(?:^|(?<=[\s;{}]))upstream\s+(\S+)\s*\{([^}]*)\}')
+UPSTREAM_SERVER = re.compile(r'(?:^|(?<=[\s;{]))server\s+(?:[a-z]+://)?([^\s:;/]+)')
+PASS = re.compile(r'(?:^|(?<=[\s;{}]))(?:proxy|uwsgi|fastcgi|grpc|scgi)_pass\s+(?:[a-z]+://)?([^\s:;/]+)')
+# directives that send a request on to another location, and where to
+REROUTE = re.compile(r'(?:^|(?<=[\s;{}]))(rewrite|try_files|error_page|auth_request|mirror)\s+([^;{}]*);')
+# a service name for "could be any of them" (proxy_pass $somewhere)
+ANY_SERVICE = '*'
+
+# stands in for "every test" when a change can't be pinned to particular ones
+EVERYTHING = None
+
+
+def _sha(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fingerprints(named_configs):
+    """
+    {name: hash} for a list of (name, config) tuples as read from the yaml.
+    """
+    return {name: _sha(conf) for name, conf in (named_configs or [])}
+
+
+def changed_names(old, new):
+    """
+    Names whose fingerprint differs between two {name: hash} dicts,
+    including names only in one of them.
+    """
+    return {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+
+
+def service_fingerprints(config):
+    return {**fingerprints(config.get('services')),
+            **fingerprints(config.get('nginx', {}).get('services'))}
+
+
+def split_locations(text):
+    """
+    Split an nginx conf into its outermost `location` blocks and everything
+    else. Returns (rest, {location header: block}), or None if the braces
+    don't balance and the file can't be picked apart.
+    """
+    text = COMMENT.sub('', text)
+    rest, blocks = [], {}
+    pos = 0
+    while True:
+        match = LOCATION.search(text, pos)
+        if not match:
+            break
+        depth, end = 0, match.end() - 1
+        while end < len(text):
+            if text[end] == '{':
+                depth += 1
+            elif text[end] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        if depth != 0:
+            return None
+        header = ' '.join(match.group(1).split())
+        key, n = header, 1
+        while key in blocks:
+            n += 1
+            key = f'{header} #{n}'
+        rest.append(text[pos:match.start()])
+        blocks[key] = text[match.start():end + 1]
+        pos = end + 1
+    rest.append(text[pos:])
+    return ''.join(rest), blocks
+
+
+def reroute_targets(text):
+    """
+    Where the rewrite, try_files, error_page, auth_request and mirror
+    directives in `text` can send a request: uris, @named locations, or
+    None for a target built from variables that could be anything.
+    """
+    targets = set()
+    for directive, args in REROUTE.findall(COMMENT.sub('', text)):
+        args = args.split()
+        if not args:
+            continue
+        if directive == 'rewrite':
+            target = args[1] if len(args) > 1 else None
+        else:
+            target = args[-1]
+        if directive == 'try_files' and target.startswith('='):
+            continue
+        if target is None or '$' in target.split('?')[0]:
+            targets.add(None)
+        elif not target.startswith(('http://', 'https://')):
+            targets.add(target.split('?')[0])
+    return targets
+
+
+def upstream_services(text, upstreams):
+    """
+    The hosts the *_pass directives in `text` send requests to, with named
+    `upstreams` ({name: [hosts]}) expanded. ANY_SERVICE if one is a variable.
+    """
+    services = set()
+    for host in PASS.findall(text):
+        if host.startswith('$') or host == 'unix':
+            # a variable, or a socket we can't tie to a service by name
+            services.add(ANY_SERVICE)
+        else:
+            services.update(upstreams.get(host, [host]))
+    return sorted(services)
+
+
+def nginx_fingerprint(conf_dir):
+    """
+    {conf file: {'rest': hash, 'locations': {header: hash}, 'upstreams':
+    {header: [service]}, 'reroutes': [target]}} for every file under
+    `conf_dir`. Files that can't be split hash as a whole under 'rest'.
+    """
+    texts = {}
+    for root, _, files in os.walk(conf_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, errors='replace') as f:
+                texts[os.path.relpath(path, conf_dir)] = f.read()
+    # upstream blocks can live in another file than the locations using them
+    upstreams = {}
+    for text in texts.values():
+        for name, body in UPSTREAM.findall(COMMENT.sub('', text)):
+            upstreams.setdefault(name, []).extend(UPSTREAM_SERVER.findall(body))
+
+    fingerprint = {}
+    for conf_file, text in texts.items():
+        reroutes = sorted(reroute_targets(text), key=lambda t: (t is None, t or ''))
+        split = split_locations(text)
+        if split is None:
+            fingerprint[conf_file] = {'rest': _sha(text), 'locations': {}, 'upstreams': {}, 'reroutes': reroutes}
+        else:
+            rest, blocks = split
+            fingerprint[conf_file] = {
+                'rest': _sha(' '.join(rest.split())),
+                'locations': {header: _sha(block) for header, block in blocks.items()},
+                'upstreams': {header: upstream_services(block, upstreams) for header, block in blocks.items()},
+                'reroutes': reroutes,
+            }
+    return fingerprint
+
+
+def location_matches(header, path):
+    """
+    Could a request for `path` land in the location with this header?
+    Named locations (@name) and patterns we can't compile count as yes.
+    """
+    header = re.sub(r' #\d+$', '', header)
+    if header.startswith('@'):
+        return True
+    modifier, pattern = LOCATION_MODIFIER.match(header).groups()
+    pattern = pattern.strip('"\'')
+    if modifier == '=':
+        return path == pattern
+    if modifier in ('~', '~*'):
+        try:
+            return re.search(pattern, path, re.IGNORECASE if modifier == '~*' else 0) is not None
+        except re.error:
+            return True
+    return path.startswith(pattern)
+
+
+def changed_locations(old, new):
+    """
+    Headers of the locations that were added, removed or edited between two
+    nginx fingerprints, or EVERYTHING if something outside a location block
+    changed (a server block, an upstream, a whole file).
+    """
+    if old.keys() != new.keys():
+        return EVERYTHING
+    headers = set()
+    for conf_file, new_conf in new.items():
+        old_conf = old[conf_file]
+        if old_conf['rest'] != new_conf['rest']:
+            return EVERYTHING
+        headers |= changed_names(old_conf['locations'], new_conf['locations'])
+    return headers
+
+
+def affected_by_nginx(tests, old, new, hits=None):
+    """
+    Tests that could be routed through a location that changed between nginx
+    fingerprints `old` and `new`: their target matches it, or last time (per
+    `hits`, {test name: ["service.route"]}) they reached a service it passes
+    to, before or after the change. If a rewrite, try_files, error_page, etc.
+    anywhere could send a request into a changed location, a test's target
+    says nothing about where it ends up, so every test is picked.
+    """
+    headers = changed_locations(old, new)
+    if headers is EVERYTHING:
+        return list(tests)
+    if not headers:
+        return []
+
+    targets = set()
+    for conf in [*old.values(), *new.values()]:
+        targets.update(conf.get('reroutes', [None]))
+    if any(target is None or location_matches(h, target) for h in headers for target in targets):
+        return list(tests)
+
+    services = set()
+    for conf in [*old.values(), *new.values()]:
+        for header in headers:
+            if header in conf['locations']:
+                services.update(conf.get('upstreams', {}).get(header, [ANY_SERVICE]))
+
+    hits = hits or {}
+
+    def reached_changed_service(t):
+        reached = {h.split('.')[0] for h in hits.get(t.name, [])}
+        return bool(reached) and (ANY_SERVICE in services or bool(reached & services))
+
+    return [t for t in tests
+            if any(location_matches(h, t.uri.split('?')[0]) for h in headers) or reached_changed_service(t)]
+
+
+def affected_by_yaml(tests, old_tests, new_tests, old_services, new_services, hits=None):
+    """
+    Tests whose own definition changed, or that expect (or last time
+    actually reached, per `hits`) a service whose definition changed.
+    Arguments are {name: hash} dicts as made by `fingerprints`.
+    """
+    hits = hits or {}
+    changed_tests = changed_names(old_tests, new_tests)
+    changed_services = changed_names(old_services, new_services)
+
+    def touches_changed_service(t):
+        reached = {e.service for e in t.expects} | {h.split('.')[0] for h in hits.get(t.name, [])}
+        return bool(reached & changed_services)
+
+    return [t for t in tests if t.name in changed_tests or touches_changed_service(t)]
+
+
+def load_history(path=HISTORY_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def select(tests, config, nginx_conf_dir, history):
+    """
+    The tests that could be affected by what changed in the yaml and the
+    nginx confs since `history` was recorded. Tests that failed or never ran
+    last time are always picked. With no history, every test is.
+    """
+    if not history:
+        return list(tests)
+
+    past = history.get('tests', {})
+    old_tests = {name: t['fingerprint'] for name, t in past.items()}
+    hits = {name: t['hits'] for name, t in past.items()}
+    picked = affected_by_yaml(tests, old_tests, fingerprints(config.get('tests')),
+                              history.get('services', {}), service_fingerprints(config), hits)
+    picked += affected_by_nginx(tests, history.get('nginx', {}), nginx_fingerprint(nginx_conf_dir), hits)
+    picked += [t for t in tests if t.name not in past or not past[t.name]['success']]
+
+    picked_names = {t.name for t in picked}
+    return [t for t in tests if t.name in picked_names]
+
+
+def record(path, config, nginx_conf_dir, reports, history=None):
+    """
+    Save what was tested against: fingerprints of every test and service in
+    `config` and of the nginx confs, plus which routes each test in `reports`
+    reached, whether it passed and how long it took (--shard balances on
+    that). Tests that didn't run this time keep what
+    `history` says about them.
+    """
+    past = (history or {}).get('tests', {})
+    test_fps = fingerprints(config.get('tests'))
+    results = {r.test_name: r for r in reports}
+
+    tests = {}
+    for name, fingerprint in test_fps.items():
+        if name in results:
+            tests[name] = {'fingerprint': fingerprint,
+                           'success': results[name].success,
+                           'hits': sorted(set(results[name].hits)),
+                           'ms': results[name].timings.get('total')}
+        elif name in past:
+            tests[name] = past[name]
+
+    with open(path, 'w') as f:
+        json.dump({'tests': tests,
+                   'services': service_fingerprints(config),
+                   'nginx': nginx_fingerprint(nginx_conf_dir)}, f, indent=2)
@@ -1,15 +1,264 @@
+import hashlib
 import json
 import os
 import re
-import requests
 import socket
 
-from src.unettest_exceptions import RouteConfigException
+from src import endpoints
+from src.http_session import session
+from src.timings import phase
+from src.unettest_exceptions import ParseException, RouteConfigException
+
+# Sent with every test request and recorded by the mocks so the ledger can
+# tell apart the calls made on behalf of tests running side by side.
+CORRELATION_HEADER = 'X-Unettest-Id'
+
+# Headers nginx (or whatever sits in front) may add on the way to a mock.
+# Mocks copy whichever of these they get into their ledger record.
+FORWARDED_HEADERS = ['X-Forwarded-For', 'X-Forwarded-Host', 'X-Forwarded-Proto', 'X-Real-IP',
+                     'Forwarded', 'Via', 'X-Request-Start']
+
+# What the generated aiohttp mocks and ledger need installed.
+ASYNC_REQUIREMENTS = ['aiohttp>=3.8,<4']
+
+# Ledger writes are batched off the response path, so a read waits until no
+# new record has come in for this long before answering.
+LEDGER_SETTLE_MS = 10
+# ...and how long to give records that still haven't shown up after that.
+LATE_RECORD_SETTLE_MS = 250
+
+# Written into every generated app. Lets routes be slow, fail, hang up on
+# the caller or send big bodies, as configured per Route.
+BEHAVIOR_HELPERS = '''
+def _roll(status, behavior):
+    """ the status to answer with and whether to reset the connection instead """
+    if random.random() < behavior.get('reset_rate', 0):
+        return status, True
+    if random.random() < behavior.get('error_rate', 0):
+        return behavior.get('error_status', 500), False
+    return status, False
+
+
+def _delay(behavior):
+    """ seconds to wait before answering """
+    delay = behavior.get('delay_ms')
+    if delay is None:
+        return 0
+    if isinstance(delay, dict):
+        if 'mean' in delay:
+            delay = random.gauss(delay['mean'], delay.get('stddev', 0))
+        else:
+            delay = random.uniform(delay.get('min', 0), delay['max'])
+    return max(0, delay) / 1000
+
+
+@functools.lru_cache(maxsize=None)
+def _body(size):
+    return b'x' * size
+
+
+def _body_path(body):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), body['file'])
+
+
+def _chunks(body):
+    """ a route's response body a chunk at a time, gzipped if asked """
+    chunk_size = body.get('chunk_size', 65536)
+    if 'file' in body:
+        def pieces():
+            with open(_body_path(body), 'rb') as f:
+                yield from iter(lambda: f.read(chunk_size), b'')
+    elif 'text' in body:
+        def pieces():
+            yield str(body['text']).encode()
+    else:
+        def pieces():
+            for sent in range(0, body['size'], chunk_size):
+                yield _body(min(chunk_size, body['size'] - sent))
+    if not body.get('gzip'):
+        yield from pieces()
+        return
+    gz = zlib.compressobj(wbits=31)
+    for piece in pieces():
+        out = gz.compress(piece)
+        if out:
+            yield out
+    yield gz.flush()
+
+
+_wholes = {}
+
+
+def _whole(key, body):
+    """ a route's whole response body, made once """
+    if key not in _wholes:
+        _wholes[key] = b''.join(_chunks(body))
+    return _wholes[key]
+
+
+def _body_headers(body):
+    headers = {}
+    if 'content_type' in body:
+        headers['Content-Type'] = body['content_type']
+    if body.get('gzip'):
+        headers['Content-Encoding'] = 'gzip'
+    return headers
+
+
+def _hang_up(sock):
+    """ linger 0 makes the close send RST instead of FIN """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+'''
+
+# The Flask (uwsgi) flavour of hanging up, and of reading and answering with bodies.
+FLASK_HELPERS = '''
+def _respond(key, body, status):
+    """ answer with a route's configured body, streamed when it's chunked or a file """
+    if body.get('chunked') or 'file' in body:
+        return Response(_chunks(body), status=status, headers=_body_headers(body))
+    return Response(_whole(key, body), status=status, headers=_body_headers(body))
+
+def _read_body(stream):
+    """
+    (size, sha256) of the request body, read a chunk at a time so big
+    uploads never sit in memory.
+    """
+    digest, size = hashlib.sha256(), 0
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
+class _ResetConnections:
+    """
+    Hang up on requests flagged by their view instead of answering. Sits
+    outside Flask so the error handlers don't turn it into a 500.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        response = self.wsgi_app(environ, start_response)
+        if environ.get('unettest.reset'):
+            sock = environ.get('werkzeug.socket')
+            if sock is not None:
+                # the shutdown stops the server waiting on a kept-alive socket
+                _hang_up(sock)
+                sock.shutdown(socket.SHUT_RDWR)
+            raise ConnectionResetError('unettest reset the connection on purpose')
+        return response
+
+app.wsgi_app = _ResetConnections(app.wsgi_app)
+'''
+
+# The aiohttp flavour of reading and answering with bodies.
+ASYNC_HELPERS = '''
+async def _respond(request, key, body, status):
+    """
+    Answer with a route's configured body. Plain files go out with
+    sendfile, chunked bodies and gzipped files are streamed.
+    """
+    headers = _body_headers(body)
+    if 'file' in body and not (body.get('chunked') or body.get('gzip')):
+        return web.FileResponse(_body_path(body), status=status, headers=headers)
+    if not (body.get('chunked') or 'file' in body):
+        return web.Response(body=_whole(key, body), status=status, headers=headers)
+    resp = web.StreamResponse(status=status, headers=headers)
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    for chunk in _chunks(body):
+        await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+async def _read_body(content):
+    """
+    (size, sha256) of the request body, read a chunk at a time so big
+    uploads never sit in memory.
+    """
+    digest, size = hashlib.sha256(), 0
+    async for chunk in content.iter_chunked(65536):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+'''
+
+# The aiohttp flavour of writing to the ledger: records are queued and a
+# background task posts whatever has piled up in one batch.
+ASYNC_LEDGER_WRITER = '''
+LEDGER_URL = os.environ.get('LEDGER_URL', 'http://ledger:4888/log')
+LEDGER_BATCH = 500
+
+
+def _record(request, entry):
+    request.app['ledger_queue'].put_nowait(entry)
+
+
+async def _ledger_writer(app):
+    queue = app['ledger_queue'] = asyncio.Queue()
+
+    async def write():
+        async with aiohttp.ClientSession() as session:
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty() and len(batch) < LEDGER_BATCH:
+                    batch.append(queue.get_nowait())
+                try:
+                    async with session.post(LEDGER_URL, json=batch) as resp:
+                        await resp.read()
+                except aiohttp.ClientError as e:
+                    logging.error(f'failure saving {len(batch)} records to ledger: {e}')
+
+    task = asyncio.ensure_future(write())
+    yield
+    task.cancel()
+
+app.cleanup_ctx.append(_ledger_writer)
+'''
+
+def reset_ledger(test_id=None):
+    """
+    Throw away every record (and call count) in the ledger, or just the ones
+    tagged with the correlation id `test_id`.
+    """
+    params = {'test_id': test_id} if test_id is not None else {}
+    session().post(f'{endpoints.LEDGER_URL}/log/reset', params=params)
 
+@phase('drain_ledger')
+def drain_ledger(service=None, since=None, test_id=None, settle_ms=LEDGER_SETTLE_MS, with_counts=False,
+                 untagged=False):
+    """
+    Empty the ledger in a single round-trip, oldest record first.
 
-def last_call(headers=None):
-    reqs = requests.get('http://localhost:4888/log')
-    return reqs.json()
+    Optionally only take the records left by `service`, the ones stamped
+    at or after the `since` timestamp and/or the ones tagged with the
+    correlation id `test_id`, or with `untagged` the ones with no correlation
+    id at all. Anything that doesn't match stays in the ledger.
+
+    The ledger holds its answer until it has gone `settle_ms` without a new
+    (matching) record, giving the mocks' batched writes time to land.
+
+    with_counts: return (records, counts) instead, counts being the calls the
+                 ledger tallied per (service, route) for `test_id` (or every
+                 correlation id). They're handed over once, when drained
+                 without `service` or `since`.
+    """
+    params = {'settle_ms': settle_ms}
+    if with_counts:
+        params['counts'] = 1
+    if test_id is not None:
+        params['test_id'] = test_id
+    elif untagged:
+        params['test_id'] = ''
+    if service is not None:
+        params['service'] = service
+    if since is not None:
+        params['since'] = since
+    reqs = session().get(f'{endpoints.LEDGER_URL}/log/drain', params=params)
+    if not with_counts:
+        return reqs.json()
+    drained = reqs.json()
+    return drained['records'], {tuple(route.split('.', 1)): n for route, n in drained['counts'].items()}
 
 class Service:
     """
@@ -22,6 +271,8 @@ class Service:
         """
         HOME_ROUTE_NAME = "home"
         REQD_ROUTE_ATTRS = ['name', 'route', 'method', 'status']
+        BEHAVIOR_ATTRS = ['delay_ms', 'error_rate', 'error_status', 'reset_rate', 'body_size']
+        BODY_ATTRS = ['text', 'size', 'file', 'chunked', 'chunk_size', 'gzip', 'content_type']
 
         def __init__(self, config):
             self.validate_required_attrs(config)
@@ -33,6 +284,10 @@ class Service:
             if 'redirect_30x_target' in config:
                 self.redirect_30x_target = config['redirect_30x_target']
 
+            self.behavior = {k: config[k] for k in Service.Route.BEHAVIOR_ATTRS if k in config}
+            self.validate_behavior(self.behavior)
+            self.body, self.body_file = self.parse_body(config.get('body'), self.behavior.get('body_size'))
+
 
         def __str__(self):
             return f'Route -- {self.name} {self.method} {self.route_} {self.status}'
@@ -43,11 +298,61 @@ class Service:
                 if attr not in route_config:
                     raise RouteConfigException(attr)
 
+        @staticmethod
+        def validate_behavior(behavior):
+            """
+            delay_ms is a number, {min, max} (uniform) or {mean, stddev} (normal).
+            error_rate and reset_rate are chances between 0 and 1.
+            """
+            delay = behavior.get('delay_ms')
+            if isinstance(delay, dict):
+                if not ('mean' in delay or 'max' in delay):
+                    raise ParseException(f"delay_ms needs 'mean' (and 'stddev') or 'max' (and 'min'), got {delay}")
+            elif delay is not None and not isinstance(delay, (int, float)):
+                raise ParseException(f"delay_ms should be milliseconds or a distribution, got {delay}")
+            for rate in ('error_rate', 'reset_rate'):
+                if not 0 <= behavior.get(rate, 0) <= 1:
+                    raise ParseException(f"{rate} should be between 0 and 1, got {behavior[rate]}")
+
+        @staticmethod
+        def parse_body(body, body_size=None):
+            """
+            A route's `body` is a string to answer with, or one of text, size
+            (bytes of filler) or file, plus chunked, chunk_size, gzip and
+            content_type. The older `body_size: N` is `body: {size: N}`.
+
+            Returns (body, source file). A file body's `file` is rewritten to
+            where the file goes in the generated app's directory.
+            """
+            if body is None:
+                return ({'size': body_size} if body_size is not None else None), None
+            if isinstance(body, str):
+                body = {'text': body}
+            if not isinstance(body, dict):
+                raise ParseException(f"body should be some text or a mapping, got {body}")
+            unknown = set(body) - set(Service.Route.BODY_ATTRS)
+            if unknown:
+                raise ParseException(f"body doesn't know {sorted(unknown)}, try {Service.Route.BODY_ATTRS}")
+            sources = [k for k in ('text', 'size', 'file') if k in body]
+            if len(sources) != 1:
+                raise ParseException(f"body needs exactly one of text, size or file, got {body}")
+
+            body = dict(body)
+            source = None
+            if 'file' in body:
+                source = body['file']
+                if not os.path.isfile(source):
+                    raise ParseException(f"body file {source} not found")
+                tag = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:8]
+                body['file'] = f'files/{tag}_{os.path.basename(source)}'
+            return body, source
+
 
     def __init__(self, name):
         self.name = name
         self.type_ = []
         self.routes = []
+        self.routes_by_name = {}
         self.exposed_port = 0
 
 
@@ -59,10 +364,7 @@ class Service:
         """
         Get Route with name `name`.
         """
-        matching_routes = [r for r in self.routes if r.name == name]
-        if matching_routes:
-            return matching_routes.pop()
-        return None
+        return self.routes_by_name.get(name)
 
     def ask_socket_for_status(self):
         """
@@ -97,6 +399,7 @@ class Service:
             'status': 200
         } )
         self.routes.append(home_route)
+        self.routes_by_name[home_route.name] = home_route
 
 
     def add_route(self, route_config):
@@ -114,6 +417,7 @@ class Service:
             exit(f"The config file is malformed :(\n   Missing required configuration {k} in \n\n{pprint.pformat(route_config, width=20)}")
 
         self.routes.append(r)
+        self.routes_by_name[r.name] = r
 
 
     def generate_ledger(name, filename, routes):
@@ -121,44 +425,180 @@ class Service:
         unused routes arg is for signature conformity with `generate_service`
         """
         with open(filename, 'w') as f:
-            f.write('''from flask import Flask, request
+            f.write("""import asyncio
 import json
+import os
 
-app = Flask(__name__)
-
-ledger = []
+from collections import Counter, OrderedDict, deque
+from aiohttp import web
+
+app = web.Application()
+# nobody wants to read the ledger's own access log
+QUIET = True
+
+# most records kept at once. past that the oldest are dropped, so a spin-up
+# left running under load doesn't grow forever
+LEDGER_SIZE = int(os.environ.get('LEDGER_SIZE', 10000))
+
+# records per correlation id, oldest first, partitions in the order they
+# were first written to
+partitions = OrderedDict()
+size = 0
+dropped = 0
+# calls per "service.route", per correlation id. these outlive dropped records
+counts = OrderedDict()
+# loop time of the latest record per correlation id, and of any record at all
+last_write = {}
+last_any = 0.0
+MAX_SETTLE = 1.0
+
+async def home(request):
+    return web.Response(text='ledger')
+
+def store(entry):
+    global size, dropped
+    test_id = entry.get('test_id')
+    partitions.setdefault(test_id, deque()).append(entry)
+    counts.setdefault(test_id, Counter())[f"{entry.get('service')}.{entry.get('test')}"] += 1
+    size += 1
+    while size > LEDGER_SIZE:
+        oldest_id, oldest = next(iter(partitions.items()))
+        oldest.popleft()
+        size -= 1
+        dropped += 1
+        if not oldest:
+            del partitions[oldest_id]
+    while len(counts) > LEDGER_SIZE:
+        counts.popitem(last=False)
+
+def forget(test_id):
+    global size
+    size -= len(partitions.pop(test_id, ()))
+    counts.pop(test_id, None)
+    last_write.pop(test_id, None)
+
+async def log(request):
+    global last_any
+    entries = await request.json()
+    if isinstance(entries, dict):
+        entries = [entries]
+    now = asyncio.get_running_loop().time()
+    last_any = now
+    for entry in entries:
+        store(entry)
+        last_write[entry.get('test_id')] = now
+    return web.Response(text='added to ledger')
+
+async def reset(request):
+    \"\"\"
+    Forget everything, or just what's tagged with ?test_id=
+    \"\"\"
+    global size, dropped
+    if 'test_id' in request.query:
+        forget(request.query['test_id'])
+    else:
+        partitions.clear()
+        counts.clear()
+        last_write.clear()
+        size = dropped = 0
+    return web.Response(text='ledger reset')
+
+async def stats(request):
+    return web.json_response({'size': size, 'max_size': LEDGER_SIZE, 'dropped': dropped,
+                              'partitions': len(partitions)})
+
+async def settle(test_id, seconds, untagged=False):
+    loop = asyncio.get_running_loop()
+    arrived = loop.time()
+    while loop.time() - arrived < MAX_SETTLE:
+        latest = last_write.get(test_id, 0) if test_id is not None or untagged else last_any
+        remaining = seconds - (loop.time() - max(latest, arrived))
+        if remaining <= 0:
+            return
+        await asyncio.sleep(remaining)
+
+async def drain(request):
+    global size
+    service = request.query.get('service')
+    since = float(request.query['since']) if 'since' in request.query else None
+    # ?test_id= (empty) means the records nobody tagged
+    untagged = request.query.get('test_id') == ''
+    test_id = request.query.get('test_id') or None
+    await settle(test_id, float(request.query.get('settle_ms', 0)) / 1000, untagged)
+
+    def wanted(entry):
+        if service is not None and entry.get('service') != service:
+            return False
+        if since is not None and entry.get('time', 0) < since:
+            return False
+        return True
+
+    # counts can outlive their records, so look at both
+    if test_id is not None or untagged:
+        test_ids = [test_id]
+    else:
+        test_ids = list(dict.fromkeys([*partitions, *counts]))
+    drained, total = [], Counter()
+    for tid in test_ids:
+        partition = partitions.get(tid, ())
+        if service is None and since is None:
+            drained.extend(partition)
+            total.update(counts.get(tid, {}))
+            forget(tid)
+        else:
+            drained.extend(entry for entry in partition if wanted(entry))
+            kept = deque(entry for entry in partition if not wanted(entry))
+            size -= len(partition) - len(kept)
+            if kept:
+                partitions[tid] = kept
+            else:
+                partitions.pop(tid, None)
+            total.update(counts.get(tid, {}))
+    if len(test_ids) > 1:
+        drained.sort(key=lambda entry: entry.get('time', 0))
+
+    if 'counts' not in request.query:
+        return web.Response(text=json.dumps(drained))
+    return web.Response(text=json.dumps({'records': drained, 'counts': total}))
+
+app.router.add_get('/', home)
+app.router.add_post('/log', log)
+app.router.add_post('/log/reset', reset)
+app.router.add_get('/log/stats', stats)
+app.router.add_get('/log/drain', drain)
 
-import logging
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
-
-@app.route('/log', methods=['GET', 'POST'])
-def log():
-    if request.method == 'POST':
-        ledger.append(request.json)
-        return 'added to ledger'
-    elif request.method == 'GET':
-        try:
-            json_ledger = json.dumps(ledger.pop())
-            return json_ledger
-        except IndexError:
-            return json.dumps([])
-''')
+if __name__ == "__main__":
+    web.run_app(app, port=int(os.environ.get('PORT', 4888)), access_log=None)
+""")
 
 
     def generate_service(name, filename, routes):
         """
         Dynamically create a Flask app defining the Service and its Routes, saving it
         to the given filename.
+
+        This is the WSGI flavour, for services run by uwsgi next to nginx.
+        Stand-alone mocks use `generate_async_service`.
         """
         route_vars = re.compile(r'<(\w*)>')
         with open(filename, 'w') as f:
-            f.write('from flask import Flask, request, redirect\n')
+            f.write('from flask import Flask, Response, request, redirect\n')
+            f.write('import functools\n')
+            f.write('import hashlib\n')
             f.write('import inspect\n')
+            f.write('import os\n')
+            f.write('import random\n')
             f.write('import requests\n')
+            f.write('import socket\n')
+            f.write('import struct\n')
             f.write('import time\n')
+            f.write('import zlib\n')
             f.write('import json\n')
             f.write('app = Flask(__name__)\n')
+            f.write('_ledger_session = requests.Session()\n')
+            f.write("LEDGER_URL = os.environ.get('LEDGER_URL', 'http://ledger:4888/log')\n")
+            f.write(BEHAVIOR_HELPERS)
+            f.write(FLASK_HELPERS)
 
             for rt in routes:
                 return_stmnt = ''
@@ -171,17 +611,31 @@ def log():
 
                 if rt.status // 100 == 3:
                     return_stmnt = f'return redirect("{rt.redirect_30x_target}", {rt.status})'
+                elif rt.body:
+                    return_stmnt = f'return _respond("{rt.name}", {rt.body!r}, {rt.status})'
                 else:
                    return_stmnt = f'return str({rt.params}), {rt.status}'
 
                 f.write(f"""
 @app.route('{rt.route_}', methods=['{rt.method}'])
 def {rt.name}({method_vars}):
+    arrived = time.time()
     func_name = inspect.currentframe().f_code.co_name
-    rq = requests.post('http://ledger:4888/log', json={{"service": "{name}", "test": func_name, "route": "{rt.route_}",
-        "status_code": {rt.status}, "method": "{rt.method}",
-        "params": request.args, "time": time.time()}})
+    body_size, body_sha256 = _read_body(request.stream)
+    status, reset = _roll({rt.status}, {rt.behavior!r})
+    time.sleep(_delay({rt.behavior!r}))
+    rq = _ledger_session.post(LEDGER_URL, json={{"service": "{name}", "test": func_name, "route": "{rt.route_}",
+        "status_code": status, "method": "{rt.method}",
+        "params": request.args, "time": arrived, "answered": time.time(),
+        "body_size": body_size, "body_sha256": body_sha256,
+        "forwarded": {{h: request.headers[h] for h in {FORWARDED_HEADERS!r} if h in request.headers}},
+        "test_id": request.headers.get("{CORRELATION_HEADER}"), "reset": reset}})
     app.logger.info(f'{{"success" if rq.status_code == 200 else "failure"}} saving to ledger')
+    if reset:
+        request.environ['unettest.reset'] = True
+        return '', 500
+    if status != {rt.status}:
+        return 'unettest failed this on purpose', status
     {return_stmnt}
 
 """)
@@ -189,11 +643,110 @@ def {rt.name}({method_vars}):
     app.run(host='0.0.0.0')''')
 
 
-    def insert_requirements(filename):
+    def generate_async_service(name, filename, routes):
+        """
+        Dynamically create an aiohttp app defining the Service and its Routes, saving it
+        to the given filename.
+
+        Ledger records are queued and written in batches by a background task,
+        so answering never waits on the ledger.
+        """
+        # flask style <var> and <converter:var> become aiohttp {var}
+        route_vars = re.compile(r'<(?:\w+:)?(\w+)>')
+        with open(filename, 'w') as f:
+            f.write('import asyncio\n')
+            f.write('import functools\n')
+            f.write('import hashlib\n')
+            f.write('import logging\n')
+            f.write('import os\n')
+            f.write('import random\n')
+            f.write('import socket\n')
+            f.write('import struct\n')
+            f.write('import time\n')
+            f.write('import zlib\n')
+            f.write('import aiohttp\n')
+            f.write('from aiohttp import web\n')
+            f.write('app = web.Application()\n')
+            f.write(BEHAVIOR_HELPERS)
+            f.write(ASYNC_HELPERS)
+            f.write(ASYNC_LEDGER_WRITER)
+
+            for rt in routes:
+                path = route_vars.sub(r'{\1}', rt.route_)
+
+                if rt.status // 100 == 3:
+                    return_stmnt = f'return web.Response(status={rt.status}, headers={{"Location": "{rt.redirect_30x_target}"}})'
+                elif rt.body:
+                    return_stmnt = f'return await _respond(request, "{rt.name}", {rt.body!r}, {rt.status})'
+                else:
+                    return_stmnt = f'return web.Response(text=str({rt.params}), status={rt.status})'
+
+                f.write(f"""
+async def {rt.name}(request):
+    arrived = time.time()
+    body_size, body_sha256 = await _read_body(request.content)
+    status, reset = _roll({rt.status}, {rt.behavior!r})
+    await asyncio.sleep(_delay({rt.behavior!r}))
+    _record(request, {{"service": "{name}", "test": "{rt.name}", "route": "{rt.route_}",
+        "status_code": status, "method": "{rt.method}",
+        "params": {{k: request.query[k] for k in request.query.keys()}}, "time": arrived, "answered": time.time(),
+        "body_size": body_size, "body_sha256": body_sha256,
+        "forwarded": {{h: request.headers[h] for h in {FORWARDED_HEADERS!r} if h in request.headers}},
+        "test_id": request.headers.get("{CORRELATION_HEADER}"), "reset": reset}})
+    if reset:
+        _hang_up(request.transport.get_extra_info('socket'))
+        request.transport.abort()
+        return web.Response()
+    if status != {rt.status}:
+        return web.Response(text='unettest failed this on purpose', status=status)
+    {return_stmnt}
+
+app.router.add_route('{rt.method}', '{path}', {rt.name})
+""")
+            f.write('''
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, port=int(os.environ['PORT']))
+''')
+
+
+    def generate_multiplexer(filename, apps):
+        """
+        Write a `main.py` that serves several generated apps from one process,
+        each on its own port. `apps` is a list of (module_name, port) where the
+        module sits next to `filename` and defines an aiohttp `app`. Outside of
+        docker the ports are shifted by $UNETTEST_PORT_OFFSET.
+        """
+        with open(filename, 'w') as f:
+            f.write(f"""import asyncio
+import importlib
+import logging
+import os
+
+from aiohttp import web
+
+APPS = {apps!r}
+PORT_OFFSET = int(os.environ.get('UNETTEST_PORT_OFFSET', 0))
+
+async def serve():
+    for module, port in APPS:
+        module = importlib.import_module(module)
+        quiet = {{'access_log': None}} if getattr(module, 'QUIET', False) else {{}}
+        runner = web.AppRunner(module.app, **quiet)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', port + PORT_OFFSET).start()
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
+""")
+
+
+    def insert_requirements(filename, requirements=('flask', 'requests')):
         """
         Populate a `requirements.txt` at the given filename.
         """
-        requirements = ['flask', 'requests']
         with open(filename, 'w') as f:
             for requirement in requirements:
                 f.write(requirement + '\n')
@@ -201,16 +754,28 @@ def {rt.name}({method_vars}):
 
     def insert_dockerfile(filename, exposed_port):
         with open(filename, 'w') as f:
-            f.write(f"""FROM python:3.7-alpine
+            f.write(f"""FROM python:3.11-alpine
+WORKDIR /code
+ENV PORT {exposed_port}
+RUN apk add --no-cache gcc musl-dev linux-headers
+COPY requirements.txt requirements.txt
+RUN pip install -r requirements.txt
+COPY . .
+EXPOSE {exposed_port}
+CMD ["python", "main.py"]
+""")
+
+    def insert_multiplexer_dockerfile(filename, exposed_ports):
+        expose = ' '.join(str(p) for p in exposed_ports)
+        with open(filename, 'w') as f:
+            f.write(f"""FROM python:3.11-alpine
 WORKDIR /code
-ENV FLASK_APP main.py
-ENV FLASK_ENV development
-ENV FLASK_RUN_HOST 0.0.0.0
 RUN apk add --no-cache gcc musl-dev linux-headers
 COPY requirements.txt requirements.txt
 RUN pip install -r requirements.txt
 COPY . .
-CMD ["flask", "run", "-p", "{exposed_port}"]
+EXPOSE {expose}
+CMD ["python", "main.py"]
 """)
 
     def insert_uwsgi(self, service_dir):
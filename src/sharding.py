@@ -0,0 +1,96 @@
+import argparse
+import json
+
+from src import reporting
+
+# what a test with no recorded duration is guessed to take, when nothing
+# else has been recorded either
+DEFAULT_TEST_MS = 100.0
+
+
+def parse_shard(spec):
+    """
+    (i, n) from 'i/n', counting shards from 1. For argparse's type=.
+    """
+    try:
+        i, n = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N like 2/4, not '{spec}'")
+    if n < 1 or not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"shard {spec} doesn't exist, i goes from 1 to N")
+    return i, n
+
+
+def load_durations(path):
+    """
+    {test name: ms} from a --report-json file (one config, several, or
+    merged) or a --changed-only history. Empty if there's nothing there.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if 'tests' in data and isinstance(data['tests'], dict):
+        return {name: t['ms'] for name, t in data['tests'].items() if t.get('ms') is not None}
+    durations = {}
+    for results in data.get('configs', {'': data}).values():
+        for r in results.get('results', []):
+            if 'total' in r.get('timings', {}):
+                durations[r['name']] = r['timings']['total']
+    return durations
+
+
+def partition(tests, n, durations):
+    """
+    Split `tests` into `n` shards that should take about as long as each
+    other: longest test first, each onto whichever shard has the least so far
+    (ties go to the lower shard). Tests with no recorded duration count as the
+    median of the ones that have one. The same tests and durations always give
+    the same shards, on any machine. Each shard keeps the config's test order.
+    """
+    known = sorted(durations[t.name] for t in tests if t.name in durations)
+    guess = known[len(known) // 2] if known else DEFAULT_TEST_MS
+    cost = {t.name: durations.get(t.name, guess) for t in tests}
+
+    loads = [0.0] * n
+    shard_of = {}
+    for t in sorted(tests, key=lambda t: (-cost[t.name], t.name)):
+        shard = min(range(n), key=lambda s: (loads[s], s))
+        loads[shard] += cost[t.name]
+        shard_of[t.name] = shard
+
+    return [[t for t in tests if shard_of[t.name] == s] for s in range(n)], loads
+
+
+def merge(paths):
+    """
+    Put --report-json files from separate shards back together. Returns
+    {config: [Report]}, config being '' for single-config files. When the
+    same test shows up twice the later file wins.
+    """
+    merged = {}
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        for config, results in data.get('configs', {'': data}).items():
+            by_name = merged.setdefault(config, {})
+            for report in reporting.from_json(results):
+                by_name[report.test_name] = report
+    return {config: list(by_name.values()) for config, by_name in merged.items()}
+
+
+def write_merged(merged, json_path=None, junit_path=None):
+    """
+    Write what `merge` gave back in the shape a single run would have.
+    """
+    if json_path:
+        with open(json_path, 'w') as f:
+            if list(merged) == ['']:
+                json.dump(reporting.to_json(merged['']), f, indent=2)
+            else:
+                json.dump({'configs': {config: reporting.to_json(reports)
+                                       for config, reports in merged.items()}}, f, indent=2)
+    if junit_path:
+        reporting.write_junit(junit_path, [(config or 'unettest', reports) for config, reports in merged.items()])
@@ -1,20 +1,42 @@
-import json
 import requests
+import time
+import uuid
 
-from collections import namedtuple
-from src.service import last_call
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from src import endpoints
+from src.http_session import session
+from src.reporting import Assertion, ConsoleReporter, Hop, Report
+from src.timings import phase
+from src.service import drain_ledger, reset_ledger, CORRELATION_HEADER, LATE_RECORD_SETTLE_MS, LEDGER_SETTLE_MS
 
-from src.unettest_exceptions import MockServiceConnectionException, MockServiceNotFound, NginxConfigurationException
+from src.unettest_exceptions import MockServiceConnectionException, NginxConfigurationException
+
+
+def run_tests(tests, services, jobs=1, reporters=None):
+    """
+    Run every test, `jobs` at a time, handing each Report to the `reporters`
+    (just the console by default) in test order as it's ready.
+
+    With more than one job each test only drains the ledger records tagged
+    with its own correlation id.
+    """
+    reporters = [ConsoleReporter()] if reporters is None else reporters
+
+    def run_one(test):
+        with phase('test', test=test.name):
+            return run_test(test, services, isolate=jobs > 1)
 
-def run_tests(tests, services):
     test_reports = []
-    Report = namedtuple('Report', ['test_name', 'success'])
-    for test in tests:
-        print()
-        print("Testing", test.name)
-        success = run_test(test, services)
-        test_reports.append(Report(test.name, success))
-    print()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(run_one, tests) if jobs > 1 else map(run_one, tests)
+        for test, report in zip(tests, results):
+            test_reports.append(report)
+            for reporter in reporters:
+                reporter.test_done(test, report)
+
+    for reporter in reporters:
+        reporter.finish(test_reports)
     return test_reports
 
 
@@ -26,49 +48,120 @@ def analyze_test_results(test_reports):
     return failures
 
 
-def send_to_nginx(path, request_type, headers):
-    if request_type == 'GET':
-        return requests.get(f'http://localhost:4999{path}', headers=headers)
-    elif request_type == 'POST':
-        return requests.post(f'http://localhost:4999{path}', headers=headers)
+def send_to_nginx(path, request_type, headers, body=None, body_file=None):
+    """
+    Send a request with any method to nginx. A `body_file` is streamed from
+    disk rather than read into memory first.
+    """
+    url = f'{endpoints.NGINX_URL}{path}'
+    if body_file is not None:
+        with open(body_file, 'rb') as f:
+            return session().request(request_type, url, headers=headers, data=f)
+    return session().request(request_type, url, headers=headers,
+                             data=body.encode() if isinstance(body, str) else body)
+
+
+def index_reports(reports):
+    """
+    Ledger records grouped by (service, route name), in the order given.
+    """
+    by_route = {}
+    for report in reports:
+        by_route.setdefault((report['service'], report['test']), []).append(report)
+    return by_route
 
 
-def run_test(test, services):
+def upstream_hops(reports, sent_at):
     """
-    return true if success, false if failure
+    The calls the mocks answered, in the order they got them, timed from
+    `sent_at` (a time.time()). Assumes the mocks share our clock, which
+    docker containers on the same host do.
     """
-    successes = []
+    return [Hop(f"{r['service']}.{r['test']}", (r['time'] - sent_at) * 1000,
+                (r.get('answered', r['time']) - sent_at) * 1000, r.get('forwarded', {}))
+            for r in sorted(reports, key=lambda r: r['time'])]
+
+
+def busy_ms(hops):
+    """
+    Milliseconds some mock was answering. Overlapping calls count once.
+    """
+    busy, until = 0.0, None
+    for hop in hops:
+        if until is None or hop.arrived > until:
+            busy += hop.answered - hop.arrived
+            until = hop.answered
+        elif hop.answered > until:
+            busy += hop.answered - until
+            until = hop.answered
+    return busy
+
+
+def run_test(test, services, isolate=False):
+    """
+    Send the test's request and check what the mocks saw. Returns a Report.
+
+    Only ledger records tagged with this test's correlation id count, so
+    stragglers from earlier (readiness probes, the last test) stay out.
+
+    isolate: tests overlap, so rely on nginx passing the correlation header
+             through to the mocks. otherwise, when nothing tagged turns up,
+             fall back to untagged records that came in after the request
+             went out.
+    """
+    if not isolate:
+        # whatever's left over from before isn't ours
+        reset_ledger()
+
+    started = time.perf_counter()
+    sent_at = time.time()
+    test_id = uuid.uuid4().hex
+    headers = {**test.request_headers(), CORRELATION_HEADER: test_id}
 
     try:
-        send_to_nginx(test.uri, test.req_method, test.headers)
+        with phase('request', test=test.name):
+            send_to_nginx(test.uri, test.req_method, headers, test.body, test.body_file)
     except requests.exceptions.ConnectionError:
         raise MockServiceConnectionException("can't connect to service under test. perhaps an nginx misconfiguration? Is Host header correct?")
     except requests.exceptions.TooManyRedirects:
         raise NginxConfigurationException("nginx config: too many redirects")
-
-    test_reports = []
-    report = last_call(test.headers)
-    while report:
-        test_reports.append(report)
-        report = last_call(test.headers)
-
-
-    for expect in test.expects:
-        sys_under_test = services.get(expect.service)
-        if sys_under_test is None:
-            servs = [s for s in services.keys()]
-            raise MockServiceNotFound(f'service {expect.service} not found in {servs}')
-        sys_route = sys_under_test.get_route(expect.route_)
+    sent = time.perf_counter()
+
+    plan = test.plan(services)
+
+    def drain(settle_ms=LEDGER_SETTLE_MS):
+        records, calls = drain_ledger(test_id=test_id, settle_ms=settle_ms, with_counts=True)
+        if records or isolate:
+            return records, calls
+        # nginx isn't passing the correlation header on
+        records = drain_ledger(since=sent_at, untagged=True, settle_ms=0)
+        return records, Counter((r['service'], r['test']) for r in records)
+
+    test_reports, calls = drain()
+    reports_by_route = index_reports(test_reports)
+    if any(calls.get((e.service, e.route_), 0) < (1 if e.called_times is None else e.called_times) for e, _ in plan):
+        # give stragglers still on their way to the ledger one more chance
+        late, late_calls = drain(settle_ms=LATE_RECORD_SETTLE_MS)
+        test_reports += late
+        for key, reports in index_reports(late).items():
+            reports_by_route.setdefault(key, []).extend(reports)
+        for key, n in late_calls.items():
+            calls[key] = calls.get(key, 0) + n
+    drained = time.perf_counter()
+
+    assertions = []
+    for expect, sys_route in plan:
         if not sys_route:
-            print(f"  no route found '{expect.route_}' in {sys_under_test}")
-            successes.append(False)
+            assertions.append(Assertion(expect.service, expect.route_, 'route', expect.route_, None, False))
             break
 
-        test_report = None
-        for report in test_reports:
-            if report['service'] == expect.service and report['test'] == expect.route_:
-                test_report = report
-                break
+        times_called = calls.get((expect.service, expect.route_), 0)
+        if expect.called_times == 0:
+            assertions.append(Assertion(expect.service, sys_route.name, 'not_called', sys_route.route_,
+                                        times_called, times_called == 0))
+            continue
+
+        test_report = reports_by_route.get((expect.service, expect.route_), [None])[0]
 
         # target = test.uri
         # if test.uri_vars:
@@ -80,34 +173,52 @@ def run_test(test, services):
         #         # we take out `gnarly` and replace it with the <awesome> placeholder again.
         #         target = target.replace(varvalue, f'<{varname}>')
 
-        target_called = test_report['route'] == sys_route.route_
-        print(f'  asserting target route {sys_route.name} {sys_route.route_} was called . . . ', end='')
-        if target_called:
-            print('Yes')
-            successes.append(True)
-        else:
-            print('\tNo')
-            successes.append(False)
-
-        print(f'            that endpoint returned {expect.return_status} . . . ', end='')
-        if test_report['status_code'] == expect.return_status:
-            print('\tYes')
-            successes.append(True)
-        else:
-            print('\tNo')
-            successes.append(False)
-
-        print(f'            it was invoked with {expect.method} . . . ', end='')
-        if test_report['method'] == expect.method:
-            print('\tYes')
-            successes.append(True)
-        else:
-            print('\tNo')
-            successes.append(False)
-
-        print()
-
-    # print(f'            included query params {expect.params} . . . ', end='')
+        called_route = test_report['route'] if test_report else None
+        assertions.append(Assertion(expect.service, sys_route.name, 'called', sys_route.route_, called_route,
+                                    called_route == sys_route.route_))
+        if called_route != sys_route.route_:
+            continue
+
+        if expect.called_times is not None:
+            assertions.append(Assertion(expect.service, sys_route.name, 'called_times', expect.called_times,
+                                        times_called, times_called == expect.called_times))
+        if expect.return_status is not None:
+            assertions.append(Assertion(expect.service, sys_route.name, 'status', expect.return_status,
+                                        test_report['status_code'], test_report['status_code'] == expect.return_status))
+        if expect.method is not None:
+            assertions.append(Assertion(expect.service, sys_route.name, 'method', expect.method,
+                                        test_report['method'], test_report['method'] == expect.method))
+        body_size, body_sha256 = test.body_digest() if expect.body_intact else (expect.body_size, expect.body_sha256)
+        if body_size is not None:
+            assertions.append(Assertion(expect.service, sys_route.name, 'body_size', body_size,
+                                        test_report.get('body_size'), test_report.get('body_size') == body_size))
+        if body_sha256 is not None:
+            assertions.append(Assertion(expect.service, sys_route.name, 'body_sha256', body_sha256,
+                                        test_report.get('body_sha256'), test_report.get('body_sha256') == body_sha256))
+        if expect.max_ms_until_called is not None:
+            until_called = (test_report['time'] - sent_at) * 1000
+            assertions.append(Assertion(expect.service, sys_route.name, 'until_called', expect.max_ms_until_called,
+                                        until_called, until_called <= expect.max_ms_until_called))
+
     # TODO query params to come
 
-    return all(successes)
+    request_ms = (sent - started) * 1000
+    hops = upstream_hops(test_reports, sent_at)
+    if test.max_response_ms is not None:
+        assertions.append(Assertion(None, None, 'response_ms', test.max_response_ms,
+                                    request_ms, request_ms <= test.max_response_ms))
+    if test.max_upstream_hops is not None:
+        assertions.append(Assertion(None, None, 'upstream_hops', test.max_upstream_hops,
+                                    len(hops), len(hops) <= test.max_upstream_hops))
+    finished = time.perf_counter()
+
+    timings = {'request': request_ms,
+               'drain': (drained - sent) * 1000,
+               'assert': (finished - drained) * 1000,
+               'total': (finished - started) * 1000}
+    if hops:
+        timings['first_upstream'] = hops[0].arrived
+        timings['upstream'] = busy_ms(hops)
+        timings['nginx'] = timings['request'] - timings['upstream']
+    return Report(test.name, all(a.success for a in assertions),
+                  [f"{r['service']}.{r['test']}" for r in test_reports], assertions, timings, hops)
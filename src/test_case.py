@@ -1,4 +1,8 @@
-from src.unettest_exceptions import ParseException
+import hashlib
+import json
+import os
+
+from src.unettest_exceptions import MockServiceNotFound, ParseException
 
 class TestCase:
     def __init__(self, name, test_configuration):
@@ -38,15 +42,78 @@ class TestCase:
         }
         """
         self.name = name
-        self.req_method = test_configuration['send']
+        self.req_method = str(test_configuration['send']).upper()
         self.uri = test_configuration['target']
         self.headers = test_configuration.get('headers', [])
+        self.body = test_configuration.get('body', None)
+        self.body_is_json = isinstance(self.body, (dict, list))
+        if self.body_is_json:
+            self.body = json.dumps(self.body)
+        elif self.body is not None and not isinstance(self.body, str):
+            # body: 12345, body: true or a yaml date, sent as written
+            self.body = json.dumps(self.body, default=str).strip('"')
+        self.body_file = test_configuration.get('body_file', None)
+        if self.body is not None and self.body_file is not None:
+            raise ParseException(f'test {name} has both a `body` and a `body_file`, pick one')
+        if self.body_file is not None and not os.path.isfile(self.body_file):
+            raise ParseException(f'test {name} `body_file` {self.body_file} not found')
+        self._body_digest = None
         self.uri_vars = test_configuration.get('vars', None)
+        self.max_response_ms = self.parse_budget(test_configuration, 'max_response_ms')
+        self.max_upstream_hops = self.parse_budget(test_configuration, 'max_upstream_hops')
         self.expects = self.parse_expects(test_configuration['expect'])
+        self._plan = None
 
     def __str__(self):
         return f"testing {self.name}"
 
+    def request_headers(self):
+        """
+        The headers to send, with a JSON Content-Type for a body written as a
+        mapping unless the test sets its own.
+        """
+        headers = dict(self.headers or {})
+        if self.body_is_json and not any(k.lower() == 'content-type' for k in headers):
+            headers['Content-Type'] = 'application/json'
+        return headers
+
+    def body_digest(self):
+        """
+        (size, sha256) of the body this test sends, (0, sha256 of nothing)
+        when it sends none. A `body_file` is hashed a chunk at a time, once.
+        """
+        if self._body_digest is None:
+            digest, size = hashlib.sha256(), 0
+            if self.body_file is not None:
+                with open(self.body_file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        digest.update(chunk)
+                        size += len(chunk)
+            elif self.body is not None:
+                data = self.body.encode()
+                digest.update(data)
+                size = len(data)
+            self._body_digest = (size, digest.hexdigest())
+        return self._body_digest
+
+    def plan(self, services):
+        """
+        The expects resolved against `services`, worked out once and reused
+        for as long as the same services are passed in: a list of
+        (ExpectAssertion, Route) pairs, the Route being None for routes the
+        service doesn't have.
+        """
+        if self._plan is None or self._plan[0] is not services:
+            steps = []
+            for expect in self.expects:
+                sys_under_test = services.get(expect.service)
+                if sys_under_test is None:
+                    servs = [s for s in services.keys()]
+                    raise MockServiceNotFound(f'service {expect.service} not found in {servs}')
+                steps.append((expect, sys_under_test.get_route(expect.route_)))
+            self._plan = (services, steps)
+        return self._plan[1]
+
     class ExpectAssertion:
         """
         a test is (1) setup
@@ -59,10 +126,25 @@ class TestCase:
             self.called_times = test_configuration.get('called_times', None)
             self.method = test_configuration.get('method', None)
             self.return_status = test_configuration.get('return_status', None)
+            self.max_ms_until_called = TestCase.parse_budget(test_configuration, 'max_ms_until_called')
+            self.params = None
+            self.body_size = None
+            self.body_sha256 = None
+            self.body_intact = False
             called_with = test_configuration.get('called_with', None)
             if called_with:
                 self.params = called_with.get('params', None)
+                self.body_size = called_with.get('body_size', None)
+                self.body_sha256 = called_with.get('body_sha256', None)
+                self.body_intact = bool(called_with.get('body_intact', False))
+
 
+    @staticmethod
+    def parse_budget(configuration, key):
+        budget = configuration.get(key, None)
+        if budget is not None and (isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget < 0):
+            raise ParseException(f'`{key}` should be a number, not {budget!r}')
+        return budget
 
     @staticmethod
     def parse_expects(configuration):
@@ -73,5 +155,7 @@ class TestCase:
                 assertion = TestCase.ExpectAssertion(unit_under_test, expect)
                 expects.append(assertion)
             return expects
+        except ParseException:
+            raise
         except Exception as e:
             raise ParseException("Error parsing test `expects`. Is your yaml well-formed?")
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+Span = namedtuple('Span', ['name', 'start', 'end', 'thread', 'args'])
+
+__spans = []
+__started = time.perf_counter()
+
+
+@contextmanager
+def phase(name, **args):
+    """
+    Time whatever runs inside as one span of `name`. Works as a decorator
+    too. Any keyword args are kept with the span and end up in the trace.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        __spans.append(Span(name, start, time.perf_counter(), threading.get_ident(), args))
+
+
+def spans():
+    return list(__spans)
+
+
+def print_timings():
+    """
+    Print how many times each phase ran and how long it took, in the order
+    the phases first started. Phases nest and overlap (tests run with --jobs,
+    drains happen inside tests) so the totals add up to more than the run.
+    """
+    by_name = {}
+    for span in sorted(__spans, key=lambda s: s.start):
+        by_name.setdefault(span.name, []).append((span.end - span.start) * 1000)
+
+    print()
+    print(f'TIMINGS ({time.perf_counter() - __started:.2f}s wall)')
+    print(f"  {'phase':<24}{'calls':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}")
+    for name, durations in by_name.items():
+        print(f'  {name:<24}{len(durations):>7}{sum(durations) / 1000:>10.2f}'
+              f'{sum(durations) / len(durations):>10.1f}{max(durations):>10.1f}')
+    print()
+
+
+def write_trace(path):
+    """
+    Write every span as a Chrome trace (open it in chrome://tracing or
+    ui.perfetto.dev) with one row per thread.
+    """
+    pid = os.getpid()
+    events = [{'name': s.name, 'cat': 'unettest', 'ph': 'X', 'pid': pid, 'tid': s.thread,
+               'ts': (s.start - __started) * 1e6, 'dur': (s.end - s.start) * 1e6,
+               'args': {k: str(v) for k, v in s.args.items()}}
+              for s in __spans]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
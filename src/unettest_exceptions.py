@@ -12,3 +12,6 @@ class NginxConfigurationException(Exception):
 
 class RouteConfigException(Exception):
     pass
+
+class ServicesNotReadyException(Exception):
+    pass
@@ -0,0 +1,42 @@
+import os
+import time
+
+
+def snapshot(paths):
+    """
+    {file path: mtime} for every file in `paths`, walking into directories.
+    Files that vanish mid-walk are left out.
+    """
+    stamps = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    __stamp(stamps, os.path.join(root, name))
+        else:
+            __stamp(stamps, path)
+    return stamps
+
+
+def __stamp(stamps, path):
+    try:
+        stamps[path] = os.stat(path).st_mtime
+    except OSError:
+        pass
+
+
+def changes(paths, interval=1.0):
+    """
+    Yield the set of files under `paths` that were added, removed or
+    modified since the last look, checking every `interval` seconds. Never
+    returns; a quiet tree just doesn't yield.
+    """
+    before = snapshot(paths)
+    while True:
+        time.sleep(interval)
+        after = snapshot(paths)
+        changed = {p for p in before.keys() | after.keys() if before.get(p) != after.get(p)}
+        before = after
+        if changed:
+            yield changed
+
@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import requests
@@ -9,16 +10,29 @@ import traceback
 import src.ondisk_config as ondisk_config
 import src.config_reader as config_reader
 import src.local_network as local_network
+import src.local_runtime as local_runtime
+import src.endpoints as endpoints
 import src.test as test
+import src.readiness as readiness
+import src.http_session as http_session
+import src.watcher as watcher
+import src.selection as selection
+import src.load as load
+import src.multirun as multirun
+import src.sharding as sharding
+import src.reporting as reporting
+import src.timings as timings
+from src.unettest_exceptions import ServicesNotReadyException
 
 QUIT = 'q'
 RUN_TESTS = 'r'
 START_N_WAIT = 's'
 TEST_ONLY = 't'
+WATCH = 'w'
 
 
 def signal_handler(signal, frame):
-    local_network.tear_down()
+    tear_down()
     sys.exit(0)
 
 
@@ -38,6 +52,39 @@ def has_wsgi_service(spec):
             return True
     return False
 
+# whether this run brought anything up, so tear_down never takes down a
+# network it didn't start (say the one -t runs against)
+spun_up = False
+
+def spin_up(services, nginx_spec, detach=True):
+    """
+    Bring up the mocks, the ledger and nginx under docker-compose, or with
+    --no-docker just the mocks and the ledger in a local process.
+    """
+    global spun_up
+    spun_up = True
+    if args.no_docker:
+        local_runtime.spin_up(services, detach=detach)
+        return
+    ondisk_config.mk_architecture(services, nginx_spec, args.nginx_conf, args.single_container,
+                                  use_build_cache=not args.no_build_cache)
+    local_network.spin_up(detach=detach, reboot_openresty=has_wsgi_service(nginx_spec))
+
+
+def tear_down():
+    """
+    Take down whatever spin_up brought up. Safe to call more than once.
+    """
+    global spun_up
+    if not spun_up:
+        return
+    spun_up = False
+    if args.no_docker:
+        local_runtime.tear_down()
+    else:
+        local_network.tear_down()
+
+
 def choose_behavior(services, nginx_spec, tests, what_to_do):
     what_to_do = input(f"""
 Running interactive mode.
@@ -47,42 +94,52 @@ Running interactive mode.
         ({RUN_TESTS})un tests
         ({START_N_WAIT})pin up servers and let them run
         ({TEST_ONLY})est without starting servers (async mode)
+        ({WATCH})atch: keep servers up, rerun tests when configs change
         ({QUIT})uit
 
 """) if what_to_do is None else what_to_do
 
     if what_to_do.lower() == RUN_TESTS:
-        ondisk_config.mk_architecture(services, nginx_spec, args.nginx_conf)
-        has_wsgi = has_wsgi_service(nginx_spec)
-        local_network.spin_up(reboot_openresty=has_wsgi)
+        spin_up(services, nginx_spec)
 
-        wait_until_up(services)
+        try:
+            readiness.wait_until_up(services, timeout=args.ready_timeout,
+                                    exited=local_runtime.exited if args.no_docker else None)
+        except ServicesNotReadyException as e:
+            tear_down()
+            sys.exit(f'ERROR: services never came up, {e}')
 
         services = {**services, **nginx_spec['services']} if nginx_spec and 'services' in nginx_spec \
                 else services
-        test_results = test.run_tests(tests, services)
+        if args.load:
+            load.run_load(tests, duration=args.duration, rate=args.rate, concurrency=args.concurrency)
+            tear_down()
+            return
+
+        test_results = run_selected_tests(tests, services)
         failures = test.analyze_test_results(test_results)
 
         try:
             assert len(failures) == 0
         except AssertionError:
-            local_network.tear_down()
+            tear_down()
             exit_with_failures(len(failures))
 
-        local_network.tear_down()
+        tear_down()
         print_success()
 
     elif what_to_do.lower() == START_N_WAIT:
-        ondisk_config.mk_architecture(services, nginx_spec, args.nginx_conf)
-        has_wsgi = has_wsgi_service(nginx_spec)
-        local_network.spin_up(detach=False, reboot_openresty=has_wsgi)
-        local_network.tear_down()
+        spin_up(services, nginx_spec, detach=False)
+        tear_down()
 
     elif what_to_do.lower() == TEST_ONLY:
         try:
             services = {**services, **nginx_spec['services']} if nginx_spec and 'services' in nginx_spec \
                     else services
-            test_results = test.run_tests(tests, services)
+            if args.load:
+                load.run_load(tests, duration=args.duration, rate=args.rate, concurrency=args.concurrency)
+                return
+            test_results = run_selected_tests(tests, services)
             failures = test.analyze_test_results(test_results)
             assert len(failures) == 0
             print_success()
@@ -91,6 +148,11 @@ Running interactive mode.
         except AssertionError:
             exit_with_failures(len(failures))
 
+    elif what_to_do.lower() == WATCH:
+        if args.no_docker:
+            sys.exit('ERROR: --watch needs docker for now, drop --no-docker')
+        watch(services, nginx_spec, tests)
+
     elif what_to_do.lower() == QUIT:
         quit()
 
@@ -98,50 +160,255 @@ Running interactive mode.
         choose_behavior(services, tests, input('\nplease give a useful selection\n'))
 
 
-def wait_until_up(services):
-    up = [False]
-    while not all(up):
+def reporters():
+    """
+    The console, plus whichever report files were asked for.
+    """
+    sinks = [reporting.ConsoleReporter()]
+    if args.report_junit:
+        sinks.append(reporting.JUnitReporter(args.report_junit))
+    if args.report_json:
+        sinks.append(reporting.JsonReporter(args.report_json))
+    return sinks
+
+
+def run_selected_tests(tests, services):
+    """
+    Run the tests, or with --changed-only just the ones that could be
+    affected by what changed since the last recorded run.
+    """
+    if not (args.changed_only or args.full):
+        return test.run_tests(tests, services, jobs=args.jobs, reporters=reporters())
+
+    nginx_conf_dir = ondisk_config.resolve_nginx_conf_dir(args.nginx_conf)
+    history = selection.load_history(args.history)
+    picked = tests if args.full else selection.select(tests, config, nginx_conf_dir, history)
+    print(f'RUNNING {len(picked)} of {len(tests)} tests')
+
+    test_results = test.run_tests(picked, services, jobs=args.jobs, reporters=reporters())
+    selection.record(args.history, config, nginx_conf_dir, test_results, history)
+    return test_results
+
+
+@timings.phase('load_config')
+def load_config(path):
+    """
+    Returns (raw config, tests, services, nginx_spec) read from the yaml at `path`.
+    """
+    return config_reader.load(path, use_cache=not args.no_config_cache)
+
+
+def watch(services, nginx_spec, tests):
+    """
+    Bring the network up once, then keep it up: when the yaml changes only the
+    mocks whose build changed are rebuilt, when the nginx confs change nginx is
+    reloaded in place, and the affected tests are rerun either way.
+    """
+    # which routes each test reached last time it ran, for affected_by_nginx
+    hits = {}
+
+    def test_against(tests, services, nginx_spec):
+        all_services = {**services, **nginx_spec['services']} if nginx_spec and 'services' in nginx_spec \
+                else services
         try:
-            up = [requests.get(f'http://localhost:{s.exposed_port}/').status_code == 200 for s in services.values()]
-        except requests.exceptions.ConnectionError:
-            up = [False]
-
+            reports = test.run_tests(tests, all_services, jobs=args.jobs, reporters=reporters())
+            hits.update((r.test_name, r.hits) for r in reports)
+            test.analyze_test_results(reports)
+        except Exception as e:
+            print("Error running tests:", e)
+
+    spin_up(services, nginx_spec)
+    try:
+        readiness.wait_until_up(services, timeout=args.ready_timeout)
+    except ServicesNotReadyException as e:
+        tear_down()
+        sys.exit(f'ERROR: services never came up, {e}')
+    test_against(tests, services, nginx_spec)
 
-parser = argparse.ArgumentParser(usage='unettest [-hrst] [--nginx-conf NGINX_CONF] file',
+    config = config_reader.read_input_config(args.config)
+    nginx_conf_dir = ondisk_config.resolve_nginx_conf_dir(args.nginx_conf)
+    nginx_fingerprint = selection.nginx_fingerprint(nginx_conf_dir)
+    print(f"\nWATCHING {', '.join(config['files'])} and {nginx_conf_dir} (ctrl-c to stop)")
+
+    # includes can come and go as the yaml changes, the watcher rereads this
+    watched = [*config['files'], nginx_conf_dir]
+    for changed in watcher.changes(watched, interval=args.watch_interval):
+        changed = {os.path.abspath(p) for p in changed}
+        config_files = set(config['files'])
+        to_rerun = []
+
+        if changed & config_files:
+            try:
+                new_config, tests, new_services, nginx_spec = load_config(args.config)
+            except Exception as e:
+                print("There was an error parsing your config:", e)
+                continue
+            before = ondisk_config.build_digests()
+            ondisk_config.mk_architecture(new_services, nginx_spec, args.nginx_conf, args.single_container,
+                                          use_build_cache=not args.no_build_cache)
+            after = ondisk_config.build_digests()
+            rebuild = sorted(name for name in after if before.get(name) != after[name])
+            to_rerun = selection.affected_by_yaml(tests,
+                                                  selection.fingerprints(config['tests']),
+                                                  selection.fingerprints(new_config['tests']),
+                                                  selection.service_fingerprints(config),
+                                                  selection.service_fingerprints(new_config))
+            config, services = new_config, new_services
+            watched[:] = [*config['files'], nginx_conf_dir]
+            if rebuild:
+                print('REBUILDING', ', '.join(rebuild))
+                local_network.rebuild_services(rebuild)
+                if 'nginx_server' in rebuild and has_wsgi_service(nginx_spec):
+                    ondisk_config.reload_nginx_config()
+                try:
+                    readiness.wait_until_up(services, timeout=args.ready_timeout)
+                except ServicesNotReadyException as e:
+                    print(f'ERROR: services never came up, {e}')
+                    continue
+
+        if changed - config_files:
+            print('RELOADING NGINX CONFS')
+            ondisk_config.refresh_nginx_conf(nginx_conf_dir)
+            ondisk_config.reload_nginx()
+            new_fingerprint = selection.nginx_fingerprint(nginx_conf_dir)
+            picked = {t.name for t in to_rerun + selection.affected_by_nginx(tests, nginx_fingerprint, new_fingerprint, hits)}
+            to_rerun = [t for t in tests if t.name in picked]
+            nginx_fingerprint = new_fingerprint
+
+        if to_rerun:
+            test_against(to_rerun, services, nginx_spec)
+        else:
+            print('nothing to rerun')
+
+
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+    return n
+
+
+parser = argparse.ArgumentParser(usage='unettest [-hrstw] [-j JOBS] [--nginx-conf NGINX_CONF] file',
             description='if u got a network, u net test - - - NYPR - - - v0.2.0',
             epilog='help, tutorials, documentation: available ~~ http://unettest.net',
             formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=35))
-parser.add_argument('config', help='unettest yaml config', type=str)
+parser.add_argument('config', help='unettest yaml config (several run side by side with -r)', type=str, nargs='*')
 parser.add_argument('-r', '--run-tests', help='start unettest and run tests', action='store_true')
 parser.add_argument('-s', '--spin-up', help='spin up servers and wait', action='store_true')
 parser.add_argument('-t', '--test-only', help='run tests async', action='store_true')
+parser.add_argument('-w', '--watch', help='spin up, run tests, and rerun them as configs change', action='store_true')
+parser.add_argument('--watch-interval', help='seconds between checks for changes (default: 1)', type=float, default=1.0)
+parser.add_argument('--load', help='replay the tests as load against nginx instead of asserting (with -r or -t)', action='store_true')
+parser.add_argument('--duration', help='seconds of --load (default: 10)', type=float, default=10.0)
+parser.add_argument('--rate', help='--load at this many requests/second instead of as fast as --concurrency allows', type=float)
+parser.add_argument('--concurrency', help='--load requests in flight at once (default: 10)', type=positive_int,
+                    default=10)
+parser.add_argument('--changed-only', help='only run tests affected by changes since the last recorded run', action='store_true')
+parser.add_argument('--full', help='run every test (and record it) even with --changed-only', action='store_true')
+parser.add_argument('--history', help=f'where runs are recorded for --changed-only (default: {selection.HISTORY_FILE})',
+                    default=selection.HISTORY_FILE)
+parser.add_argument('--shard', help='only run shard I of N, split so shards take about as long', metavar='I/N',
+                    type=sharding.parse_shard)
+parser.add_argument('--shard-timings', help='--report-json or history file with test durations for --shard '
+                    '(default: --history)', metavar='FILE')
+parser.add_argument('--merge', help="combine shards' --report-json files into --report-json/--report-junit",
+                    nargs='+', metavar='FILE')
+parser.add_argument('--report-junit', help='also write results as JUnit XML to this file', metavar='FILE')
+parser.add_argument('--report-json', help='also write results and timings as JSON to this file', metavar='FILE')
+parser.add_argument('--timings', help='print how long each phase of the run took', action='store_true')
+parser.add_argument('--trace', help='write a chrome://tracing file of every phase to FILE', metavar='FILE')
+parser.add_argument('--no-docker', help='run the fake services locally instead of in docker, against --nginx-url',
+                    action='store_true')
+parser.add_argument('--one-network', help='run several configs as one, against a single network',
+                    action='store_true')
+parser.add_argument('--parallel-configs', help='with several configs, run this many at once (default: all)', type=positive_int)
+parser.add_argument('--nginx-url', help=f'where nginx is listening (default: {endpoints.NGINX_URL})')
 parser.add_argument('--nginx-conf', help='dir with nginx confs (default: ./nginx/)')
+parser.add_argument('--single-container', help='serve all mock services from one container', action='store_true')
+parser.add_argument('--no-config-cache', help='always parse the config instead of reusing the last parse',
+                    action='store_true')
+parser.add_argument('--no-build-cache', help='always rebuild mock service images', action='store_true')
+parser.add_argument('-j', '--jobs', help='run this many tests at once (default: 1)', type=positive_int, default=1)
+parser.add_argument('--pool-size', help='keep-alive connections per host (default: 10, or --jobs if higher)', type=int)
+parser.add_argument('--ready-timeout', help='seconds to wait for servers to come up (default: 60)', type=float, default=60)
 args = parser.parse_args()
 
-tests, services, nginx_spec = None, None, {}
+if args.merge:
+    merged = sharding.merge(args.merge)
+    sharding.write_merged(merged, args.report_json, args.report_junit)
+    failures = [r for reports in merged.values() for r in reports if not r.success]
+    for fail in failures:
+        print("FAIL ", fail.test_name)
+    print(f'MERGED {sum(len(reports) for reports in merged.values())} tests from {len(args.merge)} files')
+    if failures:
+        exit_with_failures(len(failures))
+    print_success()
+    sys.exit(0)
+if not args.config:
+    parser.error('a config file is needed (or --merge)')
+if args.shard and args.watch:
+    parser.error('--shard and --watch don\'t mix, watch the whole config')
+
+if len(args.config) > 1 and not args.one_network:
+    if not args.run_tests or args.no_docker:
+        sys.exit('ERROR: several configs only run with -r, each on its own docker network')
+    child_args = multirun.passthrough_args(sys.argv[1:], args.config,
+                                           drop={'--report-json', '--report-junit', '--parallel-configs', '--history',
+                                                 '--trace'})
+    runs = multirun.run_configs(args.config, child_args, args.parallel_configs, args.history, args.trace)
+    multirun.write_reports(runs, args.report_json, args.report_junit)
+    failed = [run for run in runs if run.returncode != 0]
+    if failed:
+        sys.exit(f'Sorry babes, {len(failed)} of {len(runs)} configs failed')
+    print_success()
+    sys.exit(0)
+if len(args.config) == 1:
+    args.config = args.config[0]
+
+endpoints.configure(nginx_url=args.nginx_url)
+http_session.configure(args.pool_size or max(http_session.DEFAULT_POOL_SIZE, args.jobs,
+                                              args.concurrency if args.load else 0))
+
+config, tests, services, nginx_spec = None, None, None, {}
 
 try:
-    config = config_reader.read_input_config(args.config)
-    tests = config_reader.parse_tests(config['tests'])
-    services = config_reader.parse_services(config['services'])
-    if 'nginx' in config:
-        nginx_spec = config_reader.parse_nginx(config['nginx'])
+    config, tests, services, nginx_spec = load_config(args.config)
 except Exception as e:
     print("There was an error parsing your config:", e)
     sys.exit(1)
 
+if args.shard:
+    i, n = args.shard
+    shards, loads = sharding.partition(tests, n, sharding.load_durations(args.shard_timings or args.history))
+    print(f'SHARD {i}/{n}: {len(shards[i - 1])} of {len(tests)} tests, about {loads[i - 1] / 1000:.1f}s')
+    tests = shards[i - 1]
+
+if args.no_docker and getattr(sys, 'frozen', False):
+    sys.exit('ERROR: --no-docker runs the fake services with python and aiohttp, '
+             'use unettest from source (pip install -r requirements.txt) for that')
+if args.no_docker and has_wsgi_service(nginx_spec):
+    sys.exit('ERROR: uwsgi services run inside the nginx container, they need docker')
+
 what_to_do = None
 
 if args.run_tests:
     what_to_do = RUN_TESTS
 elif args.spin_up:
     what_to_do = START_N_WAIT
-elif args.test_only:
+elif args.test_only or args.load:
     what_to_do = TEST_ONLY
+elif args.watch:
+    what_to_do = WATCH
 
 try:
     choose_behavior(services, nginx_spec, tests, what_to_do)
 except Exception as e:
     print("Error running unettest:", e)
     # traceback.print_exc() # uncomment to debug
+    tear_down()
     sys.exit(1)
+finally:
+    if args.timings:
+        timings.print_timings()
+    if args.trace:
+        timings.write_trace(args.trace)